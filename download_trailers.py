@@ -10,6 +10,10 @@ Some imports are declared inside of functions, so that this script can be
 # dependencies to be installed.
 """
 
+# The script is kept in a single file so that it can be copied anywhere, and
+# its classes inherit from object so that they are new-style on Python 2
+# pylint: disable=too-many-lines,useless-object-inheritance
+
 # Started on: 10.14.2011
 #
 # Copyright 2011-2017 Adam Goforth
@@ -28,33 +32,74 @@ Some imports are declared inside of functions, so that this script can be
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import contextlib
+import errno
+import cProfile
+import functools
 import io
+import itertools
 import json
+import hashlib
 import logging
+import mmap
 import os.path
+import posixpath
+import pstats
 import re
-import shutil
 import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
 
 try:
     # For Python 3.0 and later
     from configparser import ConfigParser
     from configparser import Error
     from configparser import MissingSectionHeaderError
+    from http.client import HTTPConnection
+    from http.client import HTTPException
+    from http.client import HTTPSConnection
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from queue import Empty
+    from queue import Queue
+    from socketserver import ThreadingMixIn
+    from urllib.request import build_opener
+    from urllib.request import HTTPHandler
+    from urllib.request import HTTPSHandler
     from urllib.request import urlopen
     from urllib.request import Request
     from urllib.error import HTTPError
     from urllib.error import URLError
     from urllib.parse import ParseResult
     from urllib.parse import quote
+    from urllib.parse import unquote
     from urllib.parse import urlparse
     from urllib.parse import urlunparse
 except ImportError:
     # Fall back to Python 2's naming
     from urllib import quote
+    from urllib import unquote
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
     from ConfigParser import Error
     from ConfigParser import MissingSectionHeaderError
     from ConfigParser import SafeConfigParser as ConfigParser
+    from httplib import HTTPConnection
+    from httplib import HTTPException
+    from httplib import HTTPSConnection
+    from Queue import Empty
+    from Queue import Queue
+    from urllib2 import build_opener
+    from urllib2 import HTTPHandler
+    from urllib2 import HTTPSHandler
     from urllib2 import urlopen
     from urllib2 import Request
     from urllib2 import HTTPError
@@ -64,19 +109,212 @@ except ImportError:
     from urlparse import urlunparse
 
 
+def get_thread_cpu_time():
+    """Return the CPU time of the current thread in seconds, or None if it
+    can't be measured, which is the case before Python 3.7."""
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    return None
+
+
+class TraceRecorder(object):
+    """Records spans of work, like page fetches and downloads, from all
+    threads as events in the Chrome trace event format. The trace can be
+    opened in chrome://tracing or Perfetto to see on a timeline what each
+    worker was doing and where it was stalled.
+
+    Each span records its wall time and the CPU time of its thread, so the
+    difference is the time spent waiting, e.g. on sockets. Nothing is recorded
+    until enable() is called."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.start = time.time()
+        self.events = []
+        self.thread_names = {}
+
+    def enable(self):
+        """Start recording a new trace."""
+        with self.lock:
+            self.enabled = True
+            self.start = time.time()
+            self.events = []
+            self.thread_names = {}
+
+    def disable(self):
+        """Stop recording."""
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def span(self, name, category, args=None):
+        """Context manager that records the code it wraps as a span."""
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        start_cpu = get_thread_cpu_time()
+        try:
+            yield
+        finally:
+            end_cpu = get_thread_cpu_time()
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'ts': int((start - self.start) * 1000000),
+                'dur': int((time.time() - start) * 1000000),
+                'args': args or {},
+            }
+            if start_cpu is not None:
+                event['tts'] = int(start_cpu * 1000000)
+                event['tdur'] = int((end_cpu - start_cpu) * 1000000)
+            with self.lock:
+                self.events.append(event)
+                self.thread_names[event['tid']] = (
+                    threading.current_thread().name)
+
+    def get_span_stats(self):
+        """Return a list of (name, category, calls, wall seconds, CPU
+        seconds) tuples with the totals of each kind of span, slowest first.
+        The CPU seconds are None if they can't be measured."""
+        totals = {}
+        with self.lock:
+            for event in self.events:
+                key = (event['name'], event['cat'])
+                calls, wall, cpu = totals.get(key, (0, 0, 0))
+                if cpu is not None and 'tdur' in event:
+                    cpu += event['tdur']
+                else:
+                    cpu = None
+                totals[key] = (calls + 1, wall + event['dur'], cpu)
+
+        stats = [(name, category, calls, wall / 1000000.0,
+                  None if cpu is None else cpu / 1000000.0)
+                 for (name, category), (calls, wall, cpu) in totals.items()]
+        return sorted(stats, key=lambda stat: stat[3], reverse=True)
+
+    def write(self, path):
+        """Write the trace to a file in the Chrome trace event format."""
+        with self.lock:
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                       'tid': tid, 'args': {'name': name}}
+                      for tid, name in self.thread_names.items()]
+            events.extend(self.events)
+
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        with open(path, 'wb') as trace_file:
+            trace_file.write(json.dumps(trace).encode('utf-8'))
+
+
+# The trace of the current run. Only recorded with the profile setting.
+TRACE = TraceRecorder()
+
+
+def traced(category):
+    """Decorator that records each call of a function as a span in TRACE.
+    The first argument of the call, e.g. the URL, is stored with the span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            span_args = {'arg': u'{}'.format(args[0])} if args else None
+            with TRACE.span(function.__name__, category, span_args):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TrailerFile(object):
+    """A single trailer video file found on a movie page.
+
+    The fields can also be read like the keys of a dict, e.g.
+    trailer['title'] or trailer.get('title'), and a TrailerFile is equal to a
+    dict with the same fields, so code written for the dicts that were used
+    before keeps working. The one exception is json.dumps, which needs
+    to_dict()."""
+
+    __slots__ = ('res', 'title', 'type', 'url')
+
+    def __init__(self, res, title, video_type, url):
+        self.res = res
+        self.title = title
+        self.type = video_type
+        self.url = url
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if isinstance(other, TrailerFile):
+            other = other.to_dict()
+        return isinstance(other, dict) and self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'TrailerFile({!r}, {!r}, {!r}, {!r})'.format(
+            self.res, self.title, self.type, self.url)
+
+    def keys(self):
+        """Return the names of the fields."""
+        return list(self.__slots__)
+
+    def values(self):
+        """Return the values of the fields."""
+        return [getattr(self, key) for key in self.__slots__]
+
+    def items(self):
+        """Return (name, value) tuples of the fields."""
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def get(self, key, default=None):
+        """Return the value of a field, or the default if there is no field
+        with that name."""
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def to_dict(self):
+        """Return the fields as a dict."""
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+@traced('page')
 def get_trailer_file_urls(page_url, res, types, download_all_urls):
     """Get all trailer file URLs from the given movie page in the given
-    resolution and having the given trailer types.
+    resolution and having the given trailer types. Returns a list of
+    TrailerFile objects.
     """
-    urls = []
+    return list(iter_trailer_files(page_url, res, types, download_all_urls))
 
+
+def iter_trailer_files(page_url, res, types, download_all_urls):
+    """Generator version of get_trailer_file_urls, which yields a TrailerFile
+    for each matching trailer file on the movie page."""
     # Strip trailing slash from URL if it exists
     if page_url and page_url[-1] == "/":
         page_url = page_url[:-1]
 
     film_data = load_json_from_url(page_url + '/data/page.json')
     if not film_data:
-        return urls
+        return
 
     title = film_data['page']['movie_title']
     apple_size = map_res_to_apple_size(res)
@@ -97,16 +335,78 @@ def get_trailer_file_urls(page_url, res, types, download_all_urls):
         if video_type in download_types or download_all:
             if apple_size in clip['versions']['enus']['sizes']:
                 file_info = clip['versions']['enus']['sizes'][apple_size]
-                urls.append({
-                    'res': res,
-                    'title': title,
-                    'type': video_type,
-                    'url': convert_src_url_to_file_url(file_info['src'], res),
-                })
+                yield TrailerFile(
+                    res, title, video_type,
+                    convert_src_url_to_file_url(file_info['src'], res))
             else:
                 logging.error('*** No %sp file found for %s', res, video_type)
 
-    return urls
+
+def iter_pool_results(func, items, workers):
+    """Call func on each of the items with a pool of worker threads, and
+    yield the results in the order in which they finish. An exception raised
+    by func is raised by the generator.
+
+    Only as many items as there are workers are handed to the pool at a time,
+    and the next one when a result was taken, so that the results don't pile
+    up in memory when the caller is slower than the pool."""
+    pool = ThreadPool(workers)
+    results = Queue()
+
+    def call(item):
+        """Call func and pass its result or exception to the generator."""
+        try:
+            results.put((True, func(item)))
+        except Exception as ex:  # pylint: disable=broad-except
+            results.put((False, ex))
+
+    items = iter(items)
+    pending = 0
+    try:
+        while True:
+            for item in itertools.islice(items, workers - pending):
+                pool.apply_async(call, (item,))
+                pending += 1
+            if not pending:
+                break
+
+            succeeded, result = results.get()
+            pending -= 1
+            if not succeeded:
+                raise result
+            yield result
+    finally:
+        # Stop the remaining calls if the caller stopped early
+        pool.terminate()
+        pool.join()
+
+
+def iter_pages_trailer_files(page_urls, res, types, download_all_urls,
+                             workers=4):
+    """Resolve the given movie pages concurrently with a pool of worker
+    threads, and yield a (page_url, list of TrailerFile objects) tuple for
+    each page as soon as it has been resolved. The pages are yielded in the
+    order in which they finish, not in the order they were given."""
+
+    def get_page_trailer_files(page_url):
+        """Get the trailer files for a single movie page."""
+        logging.debug('Checking for files at %s', page_url)
+        return (page_url, get_trailer_file_urls(page_url, res, types,
+                                                download_all_urls))
+
+    return iter_pool_results(get_page_trailer_files, page_urls, workers)
+
+
+def iter_feed_trailer_files(page_urls, res, types, download_all_urls,
+                            workers=4):
+    """Yield a TrailerFile for each matching trailer file on all of the given
+    movie pages, e.g. all pages in the "Just Added" feed. The pages are
+    resolved concurrently, and their files are yielded as soon as each page
+    has been resolved."""
+    pages = iter_pages_trailer_files(page_urls, res, types, download_all_urls,
+                                     workers)
+    return itertools.chain.from_iterable(
+        trailer_files for _, trailer_files in pages)
 
 
 def map_res_to_apple_size(res):
@@ -128,6 +428,29 @@ def convert_src_url_to_file_url(src_url, res):
     return src_url.replace(src_ending, file_ending)
 
 
+def get_remote_file_size(url):
+    """Return the size in bytes of the file at the given URL, as reported by
+    the server in response to a HEAD request, or None if the size could not be
+    determined."""
+    req = Request(escape_url_path(url))
+    req.get_method = lambda: 'HEAD'
+
+    with HTTP_CONCURRENCY.request() as http_request:
+        try:
+            response = HTTP_TRANSPORT.open(req)
+        except (URLError, socket.error) as ex:
+            http_request.set_error(ex)
+            logging.debug("*** Could not get the size of %s", url)
+            return None
+
+        content_length = response.info().get('Content-Length')
+        response.close()
+    if content_length is None or not content_length.isdigit():
+        return None
+
+    return int(content_length)
+
+
 def get_download_types(requested_types, all_video_types):
     """Given the requested video types and all video types for this movie,
     return the list of types that should be downloaded"""
@@ -163,6 +486,7 @@ def get_download_types(requested_types, all_video_types):
     return download_types
 
 
+@traced('history')
 def get_downloaded_files(dl_list_path):
     """Get the list of downloaded files from the text file"""
     file_list = []
@@ -180,12 +504,46 @@ def write_downloaded_files(file_list, dl_list_path):
         downloads_file.writelines(new_list)
 
 
+# Locks of the download list older than this are assumed to be left over
+# from a crashed process
+LIST_LOCK_TIMEOUT_SECONDS = 60
+
+
 def record_downloaded_file(filename, dl_list_path):
     """Appends the given filename to the text file of already downloaded
-    files"""
-    file_list = get_downloaded_files(dl_list_path)
-    file_list.append(filename)
-    write_downloaded_files(file_list, dl_list_path)
+    files. Several processes, also on different machines sharing the list
+    over NFS, can record files in the same list: appends in O_APPEND mode are
+    not atomic on NFS, so they are serialized with a lock file next to the
+    list, and synced before the lock is released."""
+    lock_path = dl_list_path + u'.lock'
+    lock_token = take_marker_file(lock_path, LIST_LOCK_TIMEOUT_SECONDS)
+    while lock_token is None:
+        time.sleep(0.05)
+        lock_token = take_marker_file(lock_path, LIST_LOCK_TIMEOUT_SECONDS)
+
+    try:
+        append_downloaded_file(filename, dl_list_path)
+    finally:
+        remove_marker_file(lock_path, lock_token)
+
+
+def append_downloaded_file(filename, dl_list_path):
+    """Append a filename to the list of downloaded files, on a line of its
+    own."""
+    needs_newline = False
+    if os.path.exists(dl_list_path) and os.path.getsize(dl_list_path) > 0:
+        with open(dl_list_path, 'rb') as downloads_file:
+            downloads_file.seek(-1, os.SEEK_END)
+            needs_newline = downloads_file.read(1) != b'\n'
+
+    line = filename + u'\n'
+    if needs_newline:
+        line = u'\n' + line
+
+    with open(dl_list_path, 'ab') as downloads_file:
+        downloads_file.write(line.encode('utf-8'))
+        downloads_file.flush()
+        os.fsync(downloads_file.fileno())
 
 
 def file_already_downloaded(file_list, movie_title, video_type, res,
@@ -196,6 +554,8 @@ def file_already_downloaded(file_list, movie_title, video_type, res,
     if requested_types.lower() == 'single_trailer':
         clean_title = clean_movie_title(movie_title)
         trailer_prefix = u'{}.trailer'.format(clean_title.lower())
+        if isinstance(file_list, DownloadHistory):
+            return file_list.has_prefix(trailer_prefix)
         movie_trailers = [f for f in file_list
                           if f.lower().startswith(trailer_prefix)]
         return bool(movie_trailers)
@@ -204,6 +564,342 @@ def file_already_downloaded(file_list, movie_title, video_type, res,
     return trailer_file_name in file_list
 
 
+# The header of a history index file: the magic bytes, the number of files,
+# the size of the Bloom filter in bits, the number of Bloom filter hashes, the
+# size of the download list when the index was built and the SHA-1 hash of
+# the end of that part of the list
+HISTORY_INDEX_HEADER = struct.Struct('<8sQQQQ20s')
+HISTORY_INDEX_MAGIC = b'TRLIDX02'
+
+# Bits per file and hashes of the Bloom filter, for about 1% false positives
+HISTORY_BLOOM_BITS_PER_FILE = 10
+HISTORY_BLOOM_HASHES = 7
+
+# When more files than this were added to the download list since the index
+# was built, the index is rebuilt
+HISTORY_INDEX_MAX_UNINDEXED = 1000
+
+# The number of bytes at the end of the indexed part of the download list
+# that are hashed to check that the list wasn't edited since the index was
+# built. Hashing the whole indexed part would read the whole list on every
+# load. Edits of the list almost always remove or reorder lines, which moves
+# the end of the indexed part.
+HISTORY_INDEX_CHECK_SIZE = 4096
+
+# Marks the parts of filenames that file_already_downloaded checks with a
+# prefix search in the single_trailer mode
+TRAILER_PREFIX_MARKER = u'.trailer'
+
+
+def get_history_index_path(dl_list_path):
+    """Return the path of the index of the list of downloaded files, which is
+    stored next to the list."""
+    return dl_list_path + u'.idx'
+
+
+def get_history_index_keys(filename):
+    """Return the keys of a filename in the Bloom filter of a history index:
+    the filename itself, and each lowercase prefix of it that ends with
+    ".trailer", so prefix searches can be checked in the filter too."""
+    keys = [u'f:' + filename]
+    lower_filename = filename.lower()
+    position = lower_filename.find(TRAILER_PREFIX_MARKER)
+    while position != -1:
+        end = position + len(TRAILER_PREFIX_MARKER)
+        keys.append(u'p:' + lower_filename[:end])
+        position = lower_filename.find(TRAILER_PREFIX_MARKER, end)
+    return keys
+
+
+def get_bloom_positions(key, bits, hashes):
+    """Return the bit positions of a key in a Bloom filter of the given size,
+    using double hashing."""
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    first, second = struct.unpack('<QQ', digest)
+    return [(first + i * second) % bits for i in range(hashes)]
+
+
+def hash_history_check_block(data):
+    """Return the SHA-1 hash of the end of the indexed part of a download
+    list, which is stored in the index to detect edits of the list."""
+    return hashlib.sha1(data[-HISTORY_INDEX_CHECK_SIZE:]).digest()
+
+
+def read_history_check_block(dl_list_path, indexed_size):
+    """Read the end of the part of a download list that was indexed, the
+    last HISTORY_INDEX_CHECK_SIZE bytes before indexed_size."""
+    start = max(0, indexed_size - HISTORY_INDEX_CHECK_SIZE)
+    with open(dl_list_path, 'rb') as downloads_file:
+        downloads_file.seek(start)
+        return downloads_file.read(indexed_size - start)
+
+
+def replace_file(source_path, target_path):
+    """Rename a file over another one, which os.rename can't do on Windows.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(source_path, target_path)
+        return
+
+    # Python 2 on Windows
+    if os.name == 'nt' and os.path.exists(target_path):
+        os.remove(target_path)
+    os.rename(source_path, target_path)
+
+
+def build_bloom_filter(filenames):
+    """Return the size in bits and the bytes of the Bloom filter of a history
+    index with the given filenames."""
+    bits = max(len(filenames) * HISTORY_BLOOM_BITS_PER_FILE, 64)
+    bloom = bytearray((bits + 7) // 8)
+    for name in filenames:
+        for key in get_history_index_keys(name):
+            for position in get_bloom_positions(key, bits,
+                                                HISTORY_BLOOM_HASHES):
+                bloom[position // 8] |= 1 << (position % 8)
+    return (bits, bytes(bloom))
+
+
+def build_history_index(dl_list_path):
+    """Build the index of the list of downloaded files. The index contains a
+    Bloom filter and the sorted filenames, so DownloadHistory can look up
+    files in a memory-mapped index without loading the whole list. The list
+    itself stays the record of downloaded files; files recorded after the
+    index was built are read from the end of the list. Returns the number of
+    files in the index."""
+    with open(dl_list_path, 'rb') as downloads_file:
+        data = downloads_file.read()
+
+    filenames = set()
+    for line in data.decode('utf-8').splitlines():
+        if line.strip():
+            filenames.add(line.strip())
+
+    # Sorted by the lowercase filename, so that both exact and
+    # case-insensitive prefix searches can use a binary search
+    records = sorted((name.lower().encode('utf-8') + b'\0' +
+                      name.encode('utf-8'))
+                     for name in filenames)
+
+    bits, bloom = build_bloom_filter(filenames)
+
+    offsets = [0]
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+
+    index_path = get_history_index_path(dl_list_path)
+    temp_path = u'{}.{}.tmp'.format(index_path, os.getpid())
+    with open(temp_path, 'wb') as index_file:
+        index_file.write(HISTORY_INDEX_HEADER.pack(
+            HISTORY_INDEX_MAGIC, len(records), bits, HISTORY_BLOOM_HASHES,
+            len(data), hash_history_check_block(data)))
+        index_file.write(bloom)
+        index_file.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+        index_file.write(b''.join(records))
+    replace_file(temp_path, index_path)
+
+    return len(records)
+
+
+# pylint: disable-next=too-many-instance-attributes
+class DownloadHistory(object):
+    """The files in the list of downloaded files, for fast lookups.
+
+    If the list has an index (see build_history_index), the index is memory
+    mapped and only the files recorded after it was built are read from the
+    list. A lookup checks the Bloom filter of the index first, and only
+    searches the sorted filenames if the filter can't rule the file out.
+    Without an index, or if the part of the list that the index was built
+    from was edited since, the whole list is read. Only the end of the
+    indexed part is compared with the index, so that loading the history
+    stays cheap even for very large lists."""
+
+    def __init__(self, dl_list_path):
+        self.dl_list_path = dl_list_path
+        self.index = None
+        self.count = 0
+        self.bloom_bits = 0
+        self.bloom_hashes = 0
+        self.bloom_offset = HISTORY_INDEX_HEADER.size
+        self.offsets_offset = 0
+        self.records_offset = 0
+        self.recent = set()
+        self.recent_lower = []
+        self.outdated = False
+
+    def load(self):
+        """Map the index, if there is a valid one, and read the files that
+        are not in the index from the list."""
+        list_size = 0
+        if os.path.exists(self.dl_list_path):
+            list_size = os.path.getsize(self.dl_list_path)
+
+        indexed_size = self.map_index(list_size)
+        if not list_size:
+            return
+
+        with open(self.dl_list_path, 'rb') as downloads_file:
+            downloads_file.seek(indexed_size)
+            data = downloads_file.read()
+        # The last line may still be being written by another process
+        for line in data.decode('utf-8', 'replace').splitlines():
+            if line.strip():
+                self.recent.add(line.strip())
+        self.recent_lower = [name.lower() for name in self.recent]
+
+    def map_index(self, list_size):
+        """Map the index file if it matches the list. Returns the size of the
+        part of the list that is in the index."""
+        index_path = get_history_index_path(self.dl_list_path)
+        if not os.path.exists(index_path):
+            return 0
+
+        if not list_size:
+            # The list was deleted or emptied to download everything again
+            logging.debug("Removing history index %s of an empty list",
+                          index_path)
+            try:
+                os.remove(index_path)
+            except OSError:
+                pass
+            return 0
+
+        with open(index_path, 'rb') as index_file:
+            header = index_file.read(HISTORY_INDEX_HEADER.size)
+            if len(header) < HISTORY_INDEX_HEADER.size:
+                return 0
+            (magic, count, bits, hashes, indexed_size,
+             indexed_hash) = HISTORY_INDEX_HEADER.unpack(header)
+            # The list was edited since the index was built
+            if (magic != HISTORY_INDEX_MAGIC or indexed_size > list_size
+                    or hash_history_check_block(read_history_check_block(
+                        self.dl_list_path, indexed_size)) != indexed_hash):
+                logging.debug("Ignoring outdated history index %s",
+                              index_path)
+                self.outdated = True
+                return 0
+            self.index = mmap.mmap(index_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+
+        self.count = count
+        self.bloom_bits = bits
+        self.bloom_hashes = hashes
+        self.offsets_offset = self.bloom_offset + (bits + 7) // 8
+        self.records_offset = self.offsets_offset + (count + 1) * 8
+        return indexed_size
+
+    def close(self):
+        """Unmap the index."""
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def needs_rebuild(self):
+        """True if the list has an index, but it is outdated, or many files
+        were recorded in the list since it was built."""
+        return self.outdated or (
+            self.index is not None and
+            len(self.recent) > HISTORY_INDEX_MAX_UNINDEXED)
+
+    def __contains__(self, filename):
+        if filename in self.recent:
+            return True
+        if not self.may_contain(u'f:' + filename):
+            return False
+
+        key = filename.lower().encode('utf-8')
+        name = filename.encode('utf-8')
+        position = self.find_first(key)
+        while position < self.count:
+            record_key, record_name = self.get_record(position)
+            if record_key != key:
+                return False
+            if record_name == name:
+                return True
+            position += 1
+        return False
+
+    def has_prefix(self, prefix):
+        """True if a file starts with the given lowercase prefix. Index
+        lookups are only possible for prefixes ending in ".trailer", the
+        others are checked in the Bloom filter as a possible match."""
+        if any(name.startswith(prefix) for name in self.recent_lower):
+            return True
+        if (prefix.endswith(TRAILER_PREFIX_MARKER) and
+                not self.may_contain(u'p:' + prefix)):
+            return False
+
+        key = prefix.encode('utf-8')
+        position = self.find_first(key)
+        if position >= self.count:
+            return False
+        return self.get_record(position)[0].startswith(key)
+
+    def may_contain(self, key):
+        """Check a key in the Bloom filter. False means the key is certainly
+        not in the index."""
+        if self.index is None:
+            return False
+        for position in get_bloom_positions(key, self.bloom_bits,
+                                            self.bloom_hashes):
+            byte = struct.unpack_from('B', self.index,
+                                      self.bloom_offset + position // 8)[0]
+            if not byte & (1 << (position % 8)):
+                return False
+        return True
+
+    def get_record(self, position):
+        """Return the lowercase and the original filename of a record in the
+        index, as UTF-8 bytes."""
+        start, end = struct.unpack_from(
+            '<QQ', self.index, self.offsets_offset + position * 8)
+        record = self.index[self.records_offset + start:
+                            self.records_offset + end]
+        key, _, name = record.partition(b'\0')
+        return (key, name)
+
+    def find_first(self, key):
+        """Return the position of the first record whose lowercase filename
+        is not less than the given key."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+@traced('history')
+def load_download_history(dl_list_path):
+    """Return a DownloadHistory for the list of downloaded files. If the list
+    has an index that is missing many recently recorded files, the index is
+    rebuilt first. An outdated index is rebuilt as well."""
+    history = DownloadHistory(dl_list_path)
+    history.load()
+    if history.needs_rebuild():
+        history.close()
+        logging.debug("Rebuilding history index for %s", dl_list_path)
+        build_history_index(dl_list_path)
+        history = DownloadHistory(dl_list_path)
+        history.load()
+    return history
+
+
+def migrate_history(dl_list_path):
+    """Build the index of the list of downloaded files, so that the following
+    runs can use it."""
+    if not os.path.exists(dl_list_path):
+        logging.error("*** Error: download list %s does not exist",
+                      dl_list_path)
+        return
+
+    count = build_history_index(dl_list_path)
+    logging.info("Indexed %s files of %s in %s", count, dl_list_path,
+                 get_history_index_path(dl_list_path))
+
+
 def escape_url_path(url):
     """Performs URL encoding on the path part of the URL."""
     url_parts = urlparse(url)
@@ -213,93 +909,2077 @@ def escape_url_path(url):
     return urlunparse(quoted_url)
 
 
+class ReplayHeaders(dict):
+    """The headers of a replayed response, with case-insensitive lookups like
+    the headers of a real response."""
+
+    def __init__(self, headers):
+        dict.__init__(self, ((k.lower(), v) for k, v in headers.items()))
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+
+class ReplayResponse(io.BytesIO):
+    """A response that is replayed from an HttpArchive. It supports the parts
+    of the urlopen response interface that this script uses."""
+
+    def __init__(self, url, status, headers, body):
+        io.BytesIO.__init__(self, body)
+        self.url = url
+        self.status = status
+        self.headers = ReplayHeaders(headers)
+
+    def getcode(self):
+        """Return the HTTP status code."""
+        return self.status
+
+    def geturl(self):
+        """Return the URL of the response."""
+        return self.url
+
+    def info(self):
+        """Return the response headers."""
+        return self.headers
+
+
+class RecordingResponse(object):
+    """A live response to a video request made while recording. The caller
+    reads the whole body, and the start of it is stored in the HttpArchive
+    as it is read."""
+
+    def __init__(self, response, archive, body_name):
+        self.response = response
+        self.archive = archive
+        self.body_name = body_name
+
+    def read(self, size=-1):
+        """Read from the live response and store what was read."""
+        if size is None or size < 0:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        self.archive.append_body(self.body_name, data)
+        return data
+
+    def getcode(self):
+        """Return the HTTP status code."""
+        return self.response.getcode()
+
+    def info(self):
+        """Return the response headers."""
+        return self.response.info()
+
+    def close(self):
+        """Close the live response."""
+        self.response.close()
+
+
+# When recording, only this many bytes of each video file are stored, which
+# keeps archives small enough to check in as test fixtures
+RECORD_MAX_MEDIA_SIZE = 1024 * 1024
+
+
+class HttpArchive(object):
+    """Records HTTP responses into a zip archive, or replays them from it
+    without using the network.
+
+    In "record" mode, every request is sent to the server, and the response
+    (or the HTTP error) is stored. The caller still gets the full response,
+    but the stored copies of video files are cut to RECORD_MAX_MEDIA_SIZE
+    bytes, and their Content-Length is changed to match. The archive is
+    written when close() is called.
+
+    In "replay" mode, responses are read from the archive. A Range request
+    that was not recorded is answered from the recorded full response. A
+    request that is not in the archive raises a URLError.
+    """
+
+    def __init__(self, path, mode):
+        if mode not in ('record', 'replay'):
+            raise ValueError("invalid archive mode: {}".format(mode))
+
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.bodies = {}
+        self.zip_file = None
+
+        if mode == 'replay':
+            # Kept open until close() is called
+            # pylint: disable-next=consider-using-with
+            self.zip_file = zipfile.ZipFile(path, 'r')
+            index = self.zip_file.read('index.json').decode('utf-8')
+            for entry in json.loads(index):
+                self.entries[entry['key']] = entry
+
+    @staticmethod
+    def get_request_key(method, url, byte_range):
+        """Return the key that identifies a request in the archive."""
+        return u'{} {} {}'.format(method, url, byte_range or '')
+
+    def open(self, req, opener):
+        """Answer the request from the archive, or, when recording, with the
+        given opener function, e.g. urlopen."""
+        if not isinstance(req, Request):
+            req = Request(req)
+
+        method = req.get_method()
+        url = req.get_full_url()
+        byte_range = req.get_header('Range')
+        key = HttpArchive.get_request_key(method, url, byte_range)
+
+        if self.mode == 'record':
+            response = self.record(key, req, opener)
+            if response is not None:
+                return response
+
+        return self.replay(key, method, url, byte_range)
+
+    def record(self, key, req, opener):
+        """Send the request to the server and store the response. Returns a
+        response with the full body for the caller, or None if the request
+        failed, in which case the error is replayed from the archive."""
+        url = req.get_full_url()
+        is_media = not get_url_path(url).endswith('.json')
+        entry = {'key': key, 'url': url, 'status': 0, 'headers': {},
+                 'reason': ''}
+        body = b''
+        response = None
+
+        try:
+            response = opener(req)
+            entry['status'] = response.getcode() or 200
+            entry['headers'] = dict(response.info().items())
+            if not is_media:
+                body = response.read()
+                response.close()
+                response = ReplayResponse(url, entry['status'],
+                                          entry['headers'], body)
+        except HTTPError as ex:
+            entry['status'] = ex.code
+            entry['reason'] = str(ex.reason)
+        except URLError as ex:
+            entry['reason'] = str(ex.reason)
+
+        headers = ReplayHeaders(entry['headers'])
+        if is_media and headers.get('Content-Length'):
+            # Keep the headers consistent with the stored body
+            size = min(int(headers.get('Content-Length')),
+                       RECORD_MAX_MEDIA_SIZE)
+            headers['content-length'] = str(size)
+        entry['headers'] = dict(headers)
+
+        # Named after the request, so that a request that is recorded again,
+        # e.g. a page that is in the feed twice, replaces its earlier body
+        entry['body'] = 'bodies/{}'.format(
+            hashlib.sha1(key.encode('utf-8')).hexdigest())
+        with self.lock:
+            self.entries[key] = entry
+            self.bodies[entry['body']] = body
+
+        if is_media and response is not None:
+            # The caller gets the whole video, the archive only its start
+            return RecordingResponse(response, self, entry['body'])
+        return response
+
+    def append_body(self, body_name, data):
+        """Add data read from a recorded video to its stored body, up to
+        RECORD_MAX_MEDIA_SIZE bytes."""
+        with self.lock:
+            body = self.bodies[body_name]
+            if len(body) < RECORD_MAX_MEDIA_SIZE:
+                missing = RECORD_MAX_MEDIA_SIZE - len(body)
+                self.bodies[body_name] = body + data[:missing]
+
+    def read_body(self, entry):
+        """Return the stored body of an archive entry."""
+        with self.lock:
+            if entry['body'] not in self.bodies:
+                self.bodies[entry['body']] = self.zip_file.read(entry['body'])
+            return self.bodies[entry['body']]
+
+    def replay(self, key, method, url, byte_range):
+        """Return the stored response for the request."""
+        entry = self.entries.get(key)
+
+        if entry is None and byte_range:
+            full_key = HttpArchive.get_request_key(method, url, None)
+            if full_key in self.entries:
+                return self.replay_range(self.entries[full_key], url,
+                                         byte_range)
+
+        if entry is None:
+            raise URLError('request not in archive: {}'.format(key))
+
+        if entry['status'] == 0:
+            raise URLError(entry['reason'])
+        if entry['status'] >= 400:
+            raise HTTPError(url, entry['status'], entry['reason'],
+                            entry['headers'], None)
+
+        return ReplayResponse(url, entry['status'], entry['headers'],
+                              self.read_body(entry))
+
+    def replay_range(self, entry, url, byte_range):
+        """Answer a Range request of the form "bytes=START-" from a recorded
+        full response."""
+        body = self.read_body(entry)
+        start = int(byte_range.split('=')[1].split('-')[0])
+        if start >= len(body):
+            raise HTTPError(url, 416, 'Requested Range Not Satisfiable',
+                            {}, None)
+
+        headers = dict(entry['headers'])
+        headers['content-length'] = str(len(body) - start)
+        headers['content-range'] = 'bytes {}-{}/{}'.format(
+            start, len(body) - 1, len(body))
+        return ReplayResponse(url, 206, headers, body[start:])
+
+    def close(self):
+        """Write the archive, when recording."""
+        if self.mode == 'record':
+            entries = sorted(self.entries.values(), key=lambda e: e['key'])
+            with zipfile.ZipFile(self.path, 'w',
+                                 zipfile.ZIP_DEFLATED) as zip_file:
+                zip_file.writestr('index.json', json.dumps(entries, indent=1))
+                for entry in entries:
+                    zip_file.writestr(entry['body'],
+                                      self.bodies[entry['body']])
+        elif self.zip_file:
+            self.zip_file.close()
+
+
+# pylint: disable-next=too-few-public-methods
+class DnsCache(object):
+    """Caches the results of getaddrinfo for ttl seconds, so that the same
+    host isn't resolved again for every request. Python can't see the TTL of
+    the DNS records, so the same TTL is used for all hosts."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        """Return the getaddrinfo results for a TCP connection to the host."""
+        key = (host, port)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+
+def interleave_address_families(addresses):
+    """Reorder getaddrinfo results so that the address families alternate,
+    starting with the family of the first address, as recommended by the
+    Happy Eyeballs algorithm (RFC 8305)."""
+    if not addresses:
+        return []
+
+    first_family = addresses[0][0]
+    first = [a for a in addresses if a[0] == first_family]
+    other = [a for a in addresses if a[0] != first_family]
+
+    interleaved = []
+    for index in range(max(len(first), len(other))):
+        interleaved.extend(first[index:index + 1])
+        interleaved.extend(other[index:index + 1])
+    return interleaved
+
+
+# How long to wait for a connection attempt before racing the next address
+HAPPY_EYEBALLS_DELAY = 0.25
+
+
+def connect_happy_eyeballs(addresses, timeout=None, source_address=None):
+    """Connect to the first of the given getaddrinfo results that accepts the
+    connection. If an attempt hasn't succeeded after HAPPY_EYEBALLS_DELAY
+    seconds, the next address is tried in parallel, so a broken IPv6 route
+    doesn't delay the connection until it times out. Returns the connected
+    socket, or raises the error of the last failed attempt."""
+    results = Queue()
+
+    def attempt(addrinfo):
+        """Try to connect to a single address."""
+        family, socktype, proto, _, sockaddr = addrinfo
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if isinstance(timeout, (int, float)):
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+        except socket.error as ex:
+            if sock is not None:
+                sock.close()
+            results.put((None, ex))
+            return
+        results.put((sock, None))
+
+    def close_late_connections(count):
+        """Close the connections that finish after the winner."""
+        for _ in range(count):
+            sock, _ = results.get()
+            if sock is not None:
+                sock.close()
+
+    remaining = list(addresses)
+    in_flight = 0
+    last_error = socket.error('no addresses to connect to')
+    while remaining or in_flight:
+        wait = None
+        if remaining:
+            thread = threading.Thread(target=attempt,
+                                      args=(remaining.pop(0),))
+            thread.daemon = True
+            thread.start()
+            in_flight += 1
+            wait = HAPPY_EYEBALLS_DELAY
+
+        try:
+            sock, error = results.get(timeout=wait)
+        except Empty:
+            continue
+
+        in_flight -= 1
+        if sock is not None:
+            if in_flight:
+                thread = threading.Thread(target=close_late_connections,
+                                          args=(in_flight,))
+                thread.daemon = True
+                thread.start()
+            return sock
+        last_error = error
+
+    raise last_error
+
+
+class FastHTTPConnection(HTTPConnection):
+    """An HTTP connection that connects through HTTP_TRANSPORT, which caches
+    DNS results and races IPv4 and IPv6 addresses. This only has an effect on
+    Python 3; Python 2 always uses socket.create_connection."""
+
+    def __init__(self, *args, **kwargs):
+        HTTPConnection.__init__(self, *args, **kwargs)
+        self._create_connection = HTTP_TRANSPORT.create_connection
+
+
+class FastHTTPSConnection(HTTPSConnection):
+    """The HTTPS version of FastHTTPConnection."""
+
+    def __init__(self, *args, **kwargs):
+        HTTPSConnection.__init__(self, *args, **kwargs)
+        self._create_connection = HTTP_TRANSPORT.create_connection
+
+
+class FastHTTPHandler(HTTPHandler):
+    """A urllib handler that opens HTTP URLs with FastHTTPConnection."""
+
+    def http_open(self, req):
+        return self.do_open(FastHTTPConnection, req)
+
+
+class FastHTTPSHandler(HTTPSHandler):
+    """A urllib handler that opens HTTPS URLs with FastHTTPSConnection."""
+
+    def https_open(self, req):
+        # pylint: disable=protected-access
+        return self.do_open(FastHTTPSConnection, req,
+                            context=getattr(self, '_context', None))
+
+
+# pylint: disable-next=too-many-instance-attributes
+class HttpTransport(object):
+    """Sends all HTTP requests made by this script. Requests go to the
+    network with urlopen, unless an HttpArchive is set, which records or
+    replays them.
+
+    After enable_fast_connections() is called, requests use an opener that
+    caches DNS results and connects with Happy Eyeballs, and the time spent
+    setting up connections is measured."""
+
+    def __init__(self):
+        self.archive = None
+        self.opener = None
+        self.dns_cache = DnsCache()
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.connect_time = 0.0
+        self.metadata_bytes = 0
+        self.metadata_compressed_bytes = 0
+
+    def enable_fast_connections(self, dns_ttl=300):
+        """Use DNS caching and Happy Eyeballs for all further requests."""
+        self.dns_cache.ttl = dns_ttl
+        self.opener = build_opener(FastHTTPHandler, FastHTTPSHandler)
+
+    def create_connection(self, address, timeout=None, source_address=None):
+        """Replacement for socket.create_connection used by
+        FastHTTPConnection."""
+        start = time.time()
+        host, port = address
+        addresses = interleave_address_families(
+            self.dns_cache.resolve(host, port))
+        sock = connect_happy_eyeballs(addresses, timeout, source_address)
+
+        with self.lock:
+            self.connections += 1
+            self.connect_time += time.time() - start
+        return sock
+
+    def record_metadata_transfer(self, compressed_size, size):
+        """Record the transferred and decompressed size of a metadata
+        response."""
+        with self.lock:
+            self.metadata_compressed_bytes += compressed_size
+            self.metadata_bytes += size
+
+    def open(self, req):
+        """Open a URL or a Request, like urlopen."""
+        opener = self.opener.open if self.opener else urlopen
+        if self.archive is not None:
+            return self.archive.open(req, opener)
+        return opener(req)
+
+    def get_metrics(self):
+        """Return a dict with the connection and DNS cache measurements."""
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'connect_time': self.connect_time,
+                'dns_cache_hits': self.dns_cache.hits,
+                'dns_cache_misses': self.dns_cache.misses,
+                'metadata_bytes': self.metadata_bytes,
+                'metadata_compressed_bytes': self.metadata_compressed_bytes,
+            }
+
+
+# All HTTP requests go through this transport. main() sets its archive when
+# recording or replaying, and enables DNS caching and Happy Eyeballs.
+HTTP_TRANSPORT = HttpTransport()
+
+
+# pylint: disable-next=too-few-public-methods
+class RequestStats(object):
+    """Measurements of a single HTTP request, filled in by the code making the
+    request and reported to an AdaptiveConcurrency controller. The kind of
+    request is "metadata" for feed, page and size fetches, and "download" for
+    the video files."""
+
+    def __init__(self, kind='metadata'):
+        self.kind = kind
+        self.start = time.time()
+        self.bytes = 0
+        self.throttled = False
+
+    def set_error(self, error):
+        """Record an error raised by the request."""
+        self.throttled = is_throttling_error(error)
+
+
+def is_throttling_error(error):
+    """Returns true if the error means that the server is overloaded or is
+    limiting our requests: HTTP 429 or 5xx responses and timeouts."""
+    if isinstance(error, HTTPError):
+        return error.code == 429 or error.code >= 500
+    if isinstance(error, URLError):
+        return isinstance(error.reason, socket.timeout)
+    return isinstance(error, socket.timeout)
+
+
+# pylint: disable-next=too-few-public-methods
+class ThroughputWindow(object):
+    """The measurements of one kind of request since the concurrency limit
+    last changed, and the throughput and latency measured for that kind in
+    earlier windows."""
+
+    def __init__(self):
+        self.last_throughput = None
+        self.best_latency = None
+        self.start = time.time()
+        self.requests = 0
+        self.bytes = 0
+        self.latency = 0.0
+
+    def reset(self):
+        """Start a new window."""
+        self.start = time.time()
+        self.requests = 0
+        self.bytes = 0
+        self.latency = 0.0
+
+
+# pylint: disable-next=too-many-instance-attributes
+class AdaptiveConcurrency(object):
+    """Limits the number of HTTP requests that are in flight at the same time,
+    and adapts the limit to the observed throughput.
+
+    Requests are measured in windows of as many requests as the current limit,
+    with a separate window for each kind of request, so that small metadata
+    fetches are never compared with large downloads. After each window, the
+    limit is raised by one if the throughput went up, and lowered by one if it
+    dropped or the latency grew a lot. When the server throttles a request
+    (HTTP 429, 5xx or a timeout), the limit is halved. The limit never goes
+    above max_limit, and every change is recorded in the decisions list.
+
+    Without a max_limit, requests are never blocked, but are still measured.
+    """
+
+    def __init__(self, max_limit=None, min_limit=1):
+        self.condition = threading.Condition()
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.windows = {}
+        self.reset()
+
+    def reset(self):
+        """Forget the measurements and decisions of the previous run."""
+        with self.condition:
+            self.requests = 0
+            self.throttled_requests = 0
+            self.total_bytes = 0
+            self.decisions = []
+
+            self.last_change = 0
+            self.windows = {}
+
+    def configure(self, limit, max_limit=None):
+        """Start a run with the given number of requests in flight. The limit
+        is raised up to max_limit while the throughput goes up, and lowered
+        when the server throttles requests or the throughput drops."""
+        self.reset()
+        with self.condition:
+            self.max_limit = max(limit, max_limit or limit)
+            self.limit = None
+            self.set_limit(limit, 'initial limit')
+
+    def reset_window(self):
+        """Start a new measurement window for every kind of request."""
+        for window in self.windows.values():
+            window.reset()
+
+    def set_limit(self, limit, reason):
+        """Change the limit and record the decision."""
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if limit != self.limit:
+            logging.debug("Concurrency limit changed from %s to %s: %s",
+                          self.limit, limit, reason)
+            self.decisions.append({
+                'time': time.time(),
+                'limit': limit,
+                'reason': reason,
+            })
+        self.limit = limit
+        self.last_change = time.time()
+        self.reset_window()
+
+    def acquire(self):
+        """Wait until another request is allowed to start."""
+        with self.condition:
+            while self.limit is not None and self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, stats):
+        """Record the measurements of a finished request and let the next
+        request start."""
+        now = time.time()
+        latency = now - stats.start
+
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            self.total_bytes += stats.bytes
+
+            if stats.throttled:
+                self.throttled_requests += 1
+
+            if self.limit is None:
+                pass
+            elif stats.throttled:
+                # Requests that started before the last change don't tell us
+                # anything about the new limit
+                if stats.start >= self.last_change:
+                    self.set_limit(self.limit // 2, 'server throttled '
+                                   'requests')
+            else:
+                window = self.windows.get(stats.kind)
+                if window is None:
+                    window = self.windows[stats.kind] = ThroughputWindow()
+                window.requests += 1
+                window.bytes += stats.bytes
+                window.latency += latency
+                if window.requests >= self.limit:
+                    self.end_window(stats.kind, window, now)
+
+            self.condition.notify_all()
+
+    def end_window(self, kind, window, now):
+        """Adjust the limit based on the measurements of the window of the
+        given kind of request that just ended."""
+        elapsed = max(now - window.start, 0.001)
+        throughput = window.bytes / elapsed
+        latency = window.latency / window.requests
+        last_throughput = window.last_throughput
+        window.last_throughput = throughput
+        if window.best_latency is None or latency < window.best_latency:
+            window.best_latency = latency
+
+        if last_throughput is None or throughput > last_throughput * 1.05:
+            self.set_limit(self.limit + 1, '{} throughput increased to {:.0f} '
+                           'bytes/s'.format(kind, throughput))
+        elif throughput < last_throughput * 0.9:
+            self.set_limit(self.limit - 1, '{} throughput dropped to {:.0f} '
+                           'bytes/s'.format(kind, throughput))
+        elif latency > window.best_latency * 2:
+            self.set_limit(self.limit - 1, '{} latency increased to {:.2f} '
+                           's'.format(kind, latency))
+        else:
+            window.reset()
+
+    @contextlib.contextmanager
+    def request(self, kind='metadata'):
+        """Context manager that wraps a single HTTP request of the given kind.
+        It yields a RequestStats object, in which the caller records the
+        number of bytes transferred and any error it handles itself."""
+        self.acquire()
+        stats = RequestStats(kind)
+        try:
+            yield stats
+        except Exception as ex:
+            stats.set_error(ex)
+            raise
+        finally:
+            self.release(stats)
+
+    def get_metrics(self):
+        """Return a dict with the measurements and decisions so far."""
+        with self.condition:
+            return {
+                'requests': self.requests,
+                'throttled_requests': self.throttled_requests,
+                'bytes': self.total_bytes,
+                'limit': self.limit,
+                'decisions': list(self.decisions),
+            }
+
+
+# All HTTP requests go through this controller. It only limits concurrency
+# once main() has configured it with the number of workers and max_workers.
+HTTP_CONCURRENCY = AdaptiveConcurrency()
+
+
+class FileProgress(object):
+    """The progress of a single file download, created by
+    DownloadProgress.start_file."""
+
+    def __init__(self, progress, name, total_size, start_size):
+        self.progress = progress
+        self.name = name
+        self.total_size = total_size
+        self.start_size = start_size
+        self.size = start_size
+        self.start = time.time()
+
+    def update(self, num_bytes):
+        """Record that num_bytes more bytes of the file were downloaded."""
+        self.progress.update(self, num_bytes)
+
+    def finish(self):
+        """Record that the download stopped, whether it succeeded or not."""
+        self.progress.finish_file(self)
+
+    def get_stats(self, now):
+        """Return a dict with the size, throughput and ETA of the file."""
+        elapsed = max(now - self.start, 0.001)
+        bytes_per_second = (self.size - self.start_size) / elapsed
+        eta = None
+        if self.total_size and bytes_per_second > 0:
+            eta = (self.total_size - self.size) / bytes_per_second
+
+        return {
+            'name': self.name,
+            'size': self.size,
+            'total_size': self.total_size,
+            'elapsed': elapsed,
+            'bytes_per_second': bytes_per_second,
+            'eta': eta,
+        }
+
+
+# pylint: disable-next=too-many-instance-attributes
+class DownloadProgress(object):
+    """Tracks the progress of all running file downloads and passes it to a
+    renderer at most once per interval.
+
+    The renderer is an object with a render(stats) method, which gets the
+    totals and the stats of each running file, and a finish_file(stats)
+    method, which gets the stats of a file when its download stops. Without a
+    renderer, the progress is only counted."""
+
+    def __init__(self, renderer=None, interval=0.5):
+        self.renderer = renderer
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.files = []
+        self.start = None
+        self.total_bytes = 0
+        self.finished_files = 0
+        self.last_render = 0
+
+    def reset(self):
+        """Forget the downloads of the previous run, so that the throughput
+        of a run is not averaged with earlier runs and the time in between."""
+        with self.lock:
+            self.files = []
+            self.start = None
+            self.total_bytes = 0
+            self.finished_files = 0
+            self.last_render = 0
+
+    def start_file(self, name, total_size=None, start_size=0):
+        """Start tracking a file download and return its FileProgress."""
+        file_progress = FileProgress(self, name, total_size, start_size)
+        with self.lock:
+            if self.start is None:
+                self.start = file_progress.start
+            self.files.append(file_progress)
+        return file_progress
+
+    def update(self, file_progress, num_bytes):
+        """Add downloaded bytes to a file, and render the progress if the
+        interval has passed."""
+        with self.lock:
+            file_progress.size += num_bytes
+            self.total_bytes += num_bytes
+            if self.renderer is None:
+                return
+            now = time.time()
+            if now - self.last_render < self.interval:
+                return
+            self.last_render = now
+            stats = self.get_stats(now)
+        self.renderer.render(stats)
+
+    def finish_file(self, file_progress):
+        """Stop tracking a file download."""
+        with self.lock:
+            if file_progress not in self.files:
+                return
+            self.files.remove(file_progress)
+            self.finished_files += 1
+        if self.renderer is not None:
+            self.renderer.finish_file(file_progress.get_stats(time.time()))
+
+    def get_stats(self, now):
+        """Return a dict with the totals across all downloads and the stats
+        of each running download. Must be called with the lock held."""
+        elapsed = max(now - (self.start or now), 0.001)
+        file_stats = [f.get_stats(now) for f in self.files]
+        remaining = [f['eta'] for f in file_stats if f['eta'] is not None]
+        return {
+            'time': now,
+            'total_bytes': self.total_bytes,
+            'bytes_per_second': self.total_bytes / elapsed,
+            'eta': max(remaining) if remaining else None,
+            'finished_files': self.finished_files,
+            'files': file_stats,
+        }
+
+
+def format_bytes(num_bytes):
+    """Format a number of bytes in a human-readable form, e.g. "12.3 MB"."""
+    for unit in ['B', 'KB', 'MB']:
+        if abs(num_bytes) < 1024:
+            return '{:.1f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return '{:.1f} GB'.format(num_bytes)
+
+
+def format_duration(seconds):
+    """Format a number of seconds as H:MM:SS, or "?" if it is unknown."""
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class TtyProgressRenderer(object):
+    """Renders download progress as a single status line that is redrawn in
+    place on a terminal, and a summary line for each finished file."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.lock = threading.Lock()
+        self.line_length = 0
+
+    def write_line(self, line, end=''):
+        """Overwrite the current status line."""
+        with self.lock:
+            padding = ' ' * max(self.line_length - len(line), 0)
+            self.stream.write('\r' + line + padding + end)
+            self.stream.flush()
+            self.line_length = 0 if end else len(line)
+
+    def clear_line(self):
+        """Erase the status line, so that other output can be written to the
+        stream. The line is drawn again on the next render."""
+        with self.lock:
+            if self.line_length:
+                self.stream.write('\r' + ' ' * self.line_length + '\r')
+                self.stream.flush()
+                self.line_length = 0
+
+    def render(self, stats):
+        """Draw the status line."""
+        files = ', '.join(
+            '{} {}'.format(f['name'], format_percent(f))
+            for f in stats['files'])
+        self.write_line('{}/s, ETA {}: {}'.format(
+            format_bytes(stats['bytes_per_second']),
+            format_duration(stats['eta']), files))
+
+    def finish_file(self, stats):
+        """Print the summary of a finished file."""
+        self.write_line('  {}: {} in {} ({}/s)'.format(
+            stats['name'], format_bytes(stats['size']),
+            format_duration(stats['elapsed']),
+            format_bytes(stats['bytes_per_second'])), end='\n')
+
+
+# pylint: disable-next=too-few-public-methods
+class ProgressLineFilter(logging.Filter):
+    """A logging filter that erases the status line of a TtyProgressRenderer
+    before a message is logged, so that the message doesn't end up appended
+    to the status line."""
+
+    def __init__(self, renderer):
+        logging.Filter.__init__(self)
+        self.renderer = renderer
+
+    def filter(self, record):
+        """Erase the status line and let the record through."""
+        self.renderer.clear_line()
+        return True
+
+
+def format_percent(file_stats):
+    """Format the completed percentage of a file, or "?" if its size is
+    unknown."""
+    if not file_stats['total_size']:
+        return '?%'
+    return '{:.0f}%'.format(100.0 * file_stats['size'] /
+                            file_stats['total_size'])
+
+
+class JsonProgressRenderer(object):
+    """Renders download progress as one JSON object per line, for other
+    programs to read."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def write_event(self, event, stats):
+        """Write a single JSON line."""
+        record = dict(stats)
+        record['event'] = event
+        self.stream.write(json.dumps(record, sort_keys=True) + '\n')
+        self.stream.flush()
+
+    def render(self, stats):
+        """Write the current progress."""
+        self.write_event('progress', stats)
+
+    def finish_file(self, stats):
+        """Write the stats of a finished file."""
+        self.write_event('finished', stats)
+
+
+# The progress of all file downloads. main() sets its renderer.
+DOWNLOAD_PROGRESS = DownloadProgress()
+
+
+class RunReport(object):
+    """Collects the numbers of a single run: the movies scanned, the files
+    planned for download, skipped because they are in the download list,
+    downloaded and failed, the bytes downloaded, the time spent in each phase
+    and the bytes and download time per host.
+
+    The phase times are summed over all worker threads, so with concurrent
+    workers they can be longer than the wall time of the run."""
+
+    COUNTERS = ('movies', 'planned', 'skipped', 'downloaded', 'failed')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new report."""
+        with self.lock:
+            self.start = time.time()
+            self.counts = dict.fromkeys(RunReport.COUNTERS, 0)
+            self.bytes = 0
+            self.phases = {}
+            self.hosts = {}
+
+    def count(self, name, amount=1):
+        """Increase one of the COUNTERS."""
+        with self.lock:
+            self.counts[name] += amount
+
+    def add_page(self, seconds):
+        """Count a movie page that took the given time to resolve."""
+        with self.lock:
+            self.counts['movies'] += 1
+            self.phases['resolve'] = (self.phases.get('resolve', 0.0) +
+                                      seconds)
+
+    def add_phase_time(self, phase, seconds):
+        """Add time spent in a phase, e.g. "discovery" or "download"."""
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def record_download(self, url, result, seconds):
+        """Record the DownloadResult of a file and the time it took."""
+        host = urlparse(url).netloc
+        with self.lock:
+            self.counts['downloaded' if result.ok else 'failed'] += 1
+            self.bytes += result.bytes_downloaded
+            self.phases['download'] = (self.phases.get('download', 0.0) +
+                                       seconds)
+            host_bytes, host_seconds = self.hosts.get(host, (0, 0.0))
+            self.hosts[host] = (host_bytes + result.bytes_downloaded,
+                                host_seconds + seconds)
+
+    def to_dict(self):
+        """Return the report as a dict that can be stored as JSON."""
+        with self.lock:
+            report = dict(self.counts)
+            report.update({
+                'start': round(self.start, 3),
+                'wall_time': round(time.time() - self.start, 3),
+                'bytes': self.bytes,
+                'phases': dict((k, round(v, 3))
+                               for k, v in self.phases.items()),
+                'hosts': dict((k, [v[0], round(v[1], 3)])
+                              for k, v in self.hosts.items()),
+            })
+            return report
+
+
+# The report of the current run. main() resets it before each run.
+RUN_REPORT = RunReport()
+
+
+def get_run_history_path(settings):
+    """Return the path of the file with the reports of past runs, which is
+    stored next to the list of downloaded files."""
+    return settings['list_file'] + u'.runs'
+
+
+def save_run_report(report, settings):
+    """Append a run report to the history of runs, logging an error if it
+    can't be written."""
+    try:
+        append_run_report(report, get_run_history_path(settings))
+    except IOError as ex:
+        logging.error("*** Error: could not save run report: %s", ex)
+
+
+def append_run_report(report, history_path):
+    """Append a run report to the history file as a single JSON line."""
+    line = json.dumps(report, sort_keys=True, separators=(',', ':')) + '\n'
+    with open(history_path, 'ab') as history_file:
+        history_file.write(line.encode('utf-8'))
+
+
+def load_run_reports(history_path, count):
+    """Return the last count run reports from the history file."""
+    if not os.path.exists(history_path):
+        return []
+
+    reports = []
+    with io.open(history_path, mode='r', encoding='utf-8') as history_file:
+        for line in history_file:
+            try:
+                reports.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return reports[-count:] if count else []
+
+
+def get_run_stats(reports):
+    """Summarize a list of run reports: totals, averages and the hosts with
+    the lowest download throughput."""
+    stats = {'runs': len(reports), 'bytes': 0, 'download_time': 0.0,
+             'wall_time': 0.0}
+    for name in RunReport.COUNTERS:
+        stats[name] = sum(r.get(name, 0) for r in reports)
+
+    hosts = {}
+    for report in reports:
+        stats['bytes'] += report.get('bytes', 0)
+        stats['wall_time'] += report.get('wall_time', 0.0)
+        stats['download_time'] += report.get('phases', {}).get('download',
+                                                               0.0)
+        for host, (host_bytes, host_seconds) in report.get('hosts',
+                                                           {}).items():
+            total_bytes, total_seconds = hosts.get(host, (0, 0.0))
+            hosts[host] = (total_bytes + host_bytes,
+                           total_seconds + host_seconds)
+
+    stats['average_wall_time'] = stats['wall_time'] / max(len(reports), 1)
+    stats['average_throughput'] = (stats['bytes'] /
+                                   max(stats['download_time'], 0.001))
+    stats['slowest_hosts'] = sorted(
+        (host_bytes / max(host_seconds, 0.001), host)
+        for host, (host_bytes, host_seconds) in hosts.items())
+
+    return stats
+
+
+def write_run_stats(stats, stream=None):
+    """Write a human-readable summary of the run stats."""
+    stream = stream or sys.stdout
+    lines = [
+        'Runs: {}'.format(stats['runs']),
+        'Movies scanned: {}'.format(stats['movies']),
+        'Files planned: {}, skipped: {}, downloaded: {}, failed: {}'.format(
+            stats['planned'], stats['skipped'], stats['downloaded'],
+            stats['failed']),
+        'Downloaded: {}'.format(format_bytes(stats['bytes'])),
+        'Average run time: {}'.format(
+            format_duration(stats['average_wall_time'])),
+        'Average throughput: {}/s'.format(
+            format_bytes(stats['average_throughput'])),
+    ]
+    if stats['slowest_hosts']:
+        lines.append('Slowest hosts:')
+        for throughput, host in stats['slowest_hosts'][:5]:
+            lines.append('    {}: {}/s'.format(host, format_bytes(throughput)))
+
+    stream.write('\n'.join(lines) + '\n')
+
+
+def log_run_report(report):
+    """Log the summary of a run."""
+    logging.debug("")
+    logging.debug("Movies scanned: %s, files planned: %s, skipped: %s, "
+                  "downloaded: %s, failed: %s", report['movies'],
+                  report['planned'], report['skipped'],
+                  report['downloaded'], report['failed'])
+    logging.debug("Downloaded %s in %s", format_bytes(report['bytes']),
+                  format_duration(report['wall_time']))
+    for phase in sorted(report['phases']):
+        logging.debug("    %s: %.1fs", phase, report['phases'][phase])
+
+
+class DownloadResult(object):
+    """The result of a call to download_trailer_file. The status is one of
+    DOWNLOADED, ALREADY_DOWNLOADED or FAILED. Only files that were not FAILED
+    are complete on disk and can be recorded as downloaded."""
+
+    DOWNLOADED = 'downloaded'
+    ALREADY_DOWNLOADED = 'already_downloaded'
+    FAILED = 'failed'
+
+    def __init__(self, status, file_path, bytes_downloaded=0, error=None):
+        self.status = status
+        self.file_path = file_path
+        self.bytes_downloaded = bytes_downloaded
+        self.error = error
+
+    @property
+    def ok(self):  # pylint: disable=invalid-name
+        """True if the file is completely downloaded."""
+        return self.status != DownloadResult.FAILED
+
+    def __repr__(self):
+        return 'DownloadResult({!r}, {!r}, {!r}, {!r})'.format(
+            self.status, self.file_path, self.bytes_downloaded, self.error)
+
+
+@traced('download')
 def download_trailer_file(url, destdir, filename):
     """Accepts a URL to a trailer video file and downloads it
     You have to spoof the user agent or the site will deny the request
-    Resumes partial downloads and skips fully-downloaded files"""
+    Resumes partial downloads and skips fully-downloaded files
+
+    The file is downloaded to a ".part" file next to the final path, which is
+    synced to disk and renamed to the final filename only once the download is
+    complete, so that a file with the final name is never incomplete. Returns
+    a DownloadResult."""
     file_path = os.path.join(destdir, filename)
-    file_exists = os.path.exists(file_path)
+    part_path = file_path + u'.part'
+
+    if os.path.exists(file_path):
+        logging.debug("*** File already downloaded, skipping")
+        return DownloadResult(DownloadResult.ALREADY_DOWNLOADED, file_path)
 
     existing_file_size = 0
-    if file_exists:
-        existing_file_size = os.path.getsize(file_path)
+    if os.path.exists(part_path):
+        existing_file_size = os.path.getsize(part_path)
 
     data = None
-    headers = {}
+    # Ask for the file as is, since byte ranges of a compressed response
+    # couldn't be used to resume the download
+    headers = {'Accept-Encoding': 'identity'}
 
-    resume_download = False
-    if file_exists and (existing_file_size > 0):
-        resume_download = True
+    if existing_file_size > 0:
         headers['Range'] = 'bytes={}-'.format(existing_file_size)
 
     req = Request(escape_url_path(url), data, headers)
 
+    with HTTP_CONCURRENCY.request('download') as http_request:
+        try:
+            server_file_handle = HTTP_TRANSPORT.open(req)
+        except HTTPError as ex:
+            http_request.set_error(ex)
+            return get_http_error_result(ex, part_path, file_path)
+        except (URLError, socket.error) as ex:
+            http_request.set_error(ex)
+            logging.error("*** Error downloading file")
+            return DownloadResult(DownloadResult.FAILED, file_path,
+                                  error=str(ex))
+
+        # Only append to the partial file if the server actually sent a range
+        if existing_file_size > 0 and server_file_handle.getcode() == 206:
+            logging.debug("  Resuming file %s", file_path)
+        else:
+            logging.debug("  Saving file to %s", file_path)
+            existing_file_size = 0
+
+        content_length = server_file_handle.info().get('Content-Length')
+        try:
+            save_part_file(server_file_handle, part_path, filename,
+                           existing_file_size, content_length)
+        except (socket.error, HTTPException) as ex:
+            http_request.set_error(ex)
+            logging.error("*** Network error while downloading file: %s", ex)
+            return DownloadResult(DownloadResult.FAILED, file_path,
+                                  error=str(ex))
+
+        bytes_downloaded = os.path.getsize(part_path) - existing_file_size
+        http_request.bytes = bytes_downloaded
+        if content_length and int(content_length) != bytes_downloaded:
+            logging.error("*** Network error while downloading file: expected "
+                          "%s bytes, got %s", content_length, bytes_downloaded)
+            return DownloadResult(DownloadResult.FAILED, file_path,
+                                  bytes_downloaded, 'incomplete download')
+
+        os.rename(part_path, file_path)
+        return DownloadResult(DownloadResult.DOWNLOADED, file_path,
+                              bytes_downloaded)
+
+
+def get_http_error_result(error, part_path, file_path):
+    """Return the DownloadResult for an HTTPError raised when requesting a
+    trailer file."""
+    if error.code == 416:
+        # The partial file already contains the whole file
+        logging.debug("*** File already downloaded, finishing")
+        os.rename(part_path, file_path)
+        return DownloadResult(DownloadResult.DOWNLOADED, file_path)
+
+    if error.code == 404:
+        logging.error("*** Error downloading file: file not found")
+        return DownloadResult(DownloadResult.FAILED, file_path,
+                              error='file not found')
+
+    logging.error("*** Error downloading file")
+    return DownloadResult(DownloadResult.FAILED, file_path,
+                          error='HTTP error {}'.format(error.code))
+
+
+def save_part_file(response, part_path, filename, existing_file_size,
+                   content_length):
+    """Write the body of a response to the ".part" file of the download of
+    filename, and sync it to disk. If existing_file_size is not 0, the body is
+    appended to the existing partial file. Raises a socket.error or
+    HTTPException if the connection fails."""
+    # Buffer 1MB at a time
+    chunk_size = 1024 * 1024
+
+    total_size = None
+    if content_length:
+        total_size = existing_file_size + int(content_length)
+    file_progress = DOWNLOAD_PROGRESS.start_file(filename, total_size,
+                                                 existing_file_size)
+
+    file_mode = 'ab' if existing_file_size else 'wb'
+    try:
+        with open(part_path, file_mode) as local_file_handle:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                local_file_handle.write(chunk)
+                file_progress.update(len(chunk))
+            local_file_handle.flush()
+            os.fsync(local_file_handle.fileno())
+    finally:
+        file_progress.finish()
+
+
+def fold_filename_case(filename):
+    """Return the case-folded form of a filename, used to compare filenames
+    on case-insensitive file systems."""
+    return getattr(filename, 'casefold', filename.lower)()
+
+
+def is_case_insensitive_dir(path):
+    """Returns true if the file system of the given directory treats
+    filenames that only differ in case as the same file."""
+    probe_path = os.path.join(path, '.trailers_case_probe')
+    try:
+        with open(probe_path, 'wb'):
+            pass
+        return os.path.exists(os.path.join(path, '.TRAILERS_CASE_PROBE'))
+    except (IOError, OSError):
+        return False
+    finally:
+        try:
+            os.remove(probe_path)
+        except OSError:
+            pass
+
+
+def create_marker_file(path, content):
+    """Atomically create a file with the given content, unless the file
+    already exists. The content is written to a temporary file first, which is
+    then hard linked to the path, so other processes, even on other machines
+    sharing the directory, never see the file without its content. Returns
+    true if the file was created."""
+    temp_path = u'{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(content.encode('utf-8'))
+    try:
+        if hasattr(os, 'link'):
+            os.link(temp_path, path)
+        else:
+            marker_fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(marker_fd, content.encode('utf-8'))
+            os.close(marker_fd)
+        return True
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+        return False
+    finally:
+        os.remove(temp_path)
+
+
+def read_marker_file(path):
+    """Return the content of a marker file, or None if it doesn't exist."""
     try:
-        server_file_handle = urlopen(req)
-    except HTTPError as ex:
-        if ex.code == 416:
-            logging.debug("*** File already downloaded, skipping")
+        with io.open(path, mode='r', encoding='utf-8') as marker_file:
+            return marker_file.read()
+    except (IOError, OSError):
+        return None
+
+
+def take_marker_file(path, stale_seconds):
+    """Create a marker file that holds a token unique to this call, e.g. a
+    claim or a lock. A marker older than stale_seconds is assumed to be left
+    over from a crashed process and is taken over. Returns the token, or None
+    if another process holds the marker."""
+    token = u'{} {} {}'.format(socket.gethostname(), os.getpid(),
+                               uuid.uuid4().hex)
+    for _ in range(2):
+        if create_marker_file(path, token):
+            return token
+
+        stale_token = read_marker_file(path)
+        try:
+            marker_age = time.time() - os.path.getmtime(path)
+        except OSError:
+            # The marker was removed in the meantime, try again
+            continue
+
+        if stale_token is None or marker_age < stale_seconds:
+            return None
+
+        logging.debug('Taking over stale marker %s', path)
+        if not remove_marker_file(path, stale_token):
+            return None
+
+    return None
+
+
+def remove_marker_file(path, token):
+    """Remove a marker file, but only if it still holds the given token. The
+    marker is renamed away first, which only one process can succeed at, and
+    put back if it turns out that another process holds it. Returns true if
+    the marker was removed."""
+    removed_path = u'{}.{}.removed'.format(path, uuid.uuid4().hex)
+    try:
+        os.rename(path, removed_path)
+    except OSError:
+        return False
+
+    if read_marker_file(removed_path) == token:
+        os.remove(removed_path)
+        return True
+
+    # Another process took the marker over in the meantime, put it back
+    try:
+        if hasattr(os, 'link'):
+            os.link(removed_path, path)
+        else:
+            os.rename(removed_path, path)
+    except OSError:
+        pass
+    if os.path.exists(removed_path):
+        os.remove(removed_path)
+    return False
+
+
+# The directory in the download directory in which FilenameIndex stores the
+# owners of the filenames
+FILENAME_OWNERS_DIR = u'.trailer_owners'
+
+
+class FilenameIndex(object):
+    """An index of the target filenames in the download directory, used to
+    make sure that two different trailer files are never downloaded to the
+    same path. This can happen because clean_movie_title removes characters
+    from titles, or on case-insensitive file systems.
+
+    The index is built once per run from the files in the download
+    directory, and every file that is going to be downloaded is reserved in
+    it with the URL of the trailer as its owner. If the filename is already
+    taken by another trailer, the trailer gets a filename with a suffix
+    derived from its URL.
+
+    The index is kept in memory, unless the download directory is shared by
+    the processes of several shards. Then the owner of each filename is also
+    stored in a marker file in the FILENAME_OWNERS_DIR directory of the
+    download directory, which is created atomically, so that processes on
+    other machines give each trailer the same filename. The marker is
+    removed once the file is in the download list, which decides who has the
+    filename from then on.
+    """
+
+    def __init__(self, case_insensitive=False):
+        self.case_insensitive = case_insensitive
+        self.lock = threading.Lock()
+        self.destdir = None
+        self.owners_dir = None
+        self.existing = {}
+        self.planned = {}
+
+    def get_key(self, filename):
+        """Return the key under which a filename is stored."""
+        if self.case_insensitive:
+            return fold_filename_case(filename)
+        return filename
+
+    def build(self, destdir, case_insensitive=False, shared=False):
+        """Reset the index to the files that exist in the download
+        directory, including partial downloads. If the directory is shared
+        with other processes, the owners of the filenames are stored in it."""
+        with self.lock:
+            self.case_insensitive = case_insensitive
+            self.destdir = destdir
+            self.owners_dir = None
+            self.planned = {}
+            self.existing = {}
+            if not os.path.isdir(destdir):
+                return
+            if shared:
+                owners_dir = os.path.join(destdir, FILENAME_OWNERS_DIR)
+                try:
+                    if not os.path.isdir(owners_dir):
+                        os.mkdir(owners_dir)
+                    self.owners_dir = owners_dir
+                except OSError as ex:
+                    logging.error("*** Error: could not create %s, filenames "
+                                  "are not shared with other shards: %s",
+                                  owners_dir, ex)
+            for filename in os.listdir(destdir):
+                for suffix in (u'.part', u'.claim'):
+                    if filename.endswith(suffix):
+                        filename = filename[:-len(suffix)]
+                self.existing[self.get_key(filename)] = filename
+
+    def is_available(self, filename, owner):
+        """Returns true if the filename can be used by the owner. A filename
+        that isn't planned yet is registered for the owner, if it doesn't
+        have an owner already."""
+        key = self.get_key(filename)
+        if key in self.planned:
+            return self.planned[key] == owner
+        # A file whose name only differs in case is another trailer
+        if self.existing.get(key, filename) != filename:
+            return False
+        if self.owners_dir is None:
+            return True
+
+        owner_path = self.get_owner_path(filename)
+        owner_url_path = get_url_path(owner)
+        owner_url = read_marker_file(owner_path)
+        if owner_url is None:
+            # A complete file without an owner was recorded in the download
+            # list by another trailer, which then released its filename
+            if os.path.exists(os.path.join(self.destdir, filename)):
+                return False
+            if create_marker_file(owner_path, owner_url_path):
+                return True
+            owner_url = read_marker_file(owner_path)
+        return owner_url == owner_url_path
+
+    def get_owner_path(self, filename):
+        """Return the path of the marker file that stores the owner of a
+        filename."""
+        return os.path.join(
+            self.owners_dir,
+            hashlib.sha1(self.get_key(filename).encode('utf-8')).hexdigest())
+
+    def reserve(self, filename, owner):
+        """Reserve a filename for the trailer with the given owner URL, and
+        return the filename that the trailer should be saved as. Raises an
+        OSError if the owner of the filename can't be stored."""
+        with self.lock:
+            candidate = filename
+            base, extension = os.path.splitext(filename)
+            suffix = u'{:08x}'.format(
+                zlib.crc32(get_url_path(owner).encode('utf-8')) & 0xffffffff)
+            attempt = 0
+            while not self.is_available(candidate, owner):
+                attempt += 1
+                candidate = u'{}.{}{}{}'.format(
+                    base, suffix, u'.{}'.format(attempt) if attempt > 1 else
+                    u'', extension)
+
+            if candidate != filename:
+                logging.debug("*** Filename %s is already used by another "
+                              "trailer, using %s", filename, candidate)
+            self.planned[self.get_key(candidate)] = owner
+            return candidate
+
+    def release(self, filename, owner):
+        """Remove the stored owner of a filename after its file was recorded
+        in the download list."""
+        if self.owners_dir is not None:
+            remove_marker_file(self.get_owner_path(filename),
+                               get_url_path(owner))
+
+
+# The target filenames of the current run. main() builds it before each run,
+# and only shares it through the download directory in shard mode.
+FILENAME_INDEX = FilenameIndex()
+
+
+def get_download_plan_entries(trailer_urls, downloaded_files,
+                              requested_types):
+    """Take the trailer URLs found on a movie page and decide for each one
+    whether it should be downloaded. Returns a list of dicts with the trailer
+    info, the target filename, the action ("download" or "skip") and the
+    reason for the action.
+
+    The filenames of the files to download are reserved in FILENAME_INDEX,
+    so trailers whose filenames collide get different filenames. A file in
+    the download list is skipped without a reservation, even if the URL of
+    the trailer changed since it was downloaded."""
+    entries = []
+    for trailer_url in trailer_urls:
+        trailer_file_name = get_trailer_filename(
+            trailer_url['title'], trailer_url['type'], trailer_url['res'])
+        if requested_types.lower() == 'single_trailer':
+            already_downloaded = file_already_downloaded(
+                downloaded_files, trailer_url['title'], trailer_url['type'],
+                trailer_url['res'], requested_types)
+        else:
+            already_downloaded = trailer_file_name in downloaded_files
+
+        if not already_downloaded:
+            trailer_file_name = FILENAME_INDEX.reserve(trailer_file_name,
+                                                       trailer_url['url'])
+            # The trailer was given another filename in an earlier run
+            already_downloaded = trailer_file_name in downloaded_files
+
+        entry = dict(trailer_url)
+        entry['filename'] = trailer_file_name
+        if already_downloaded:
+            entry['action'] = 'skip'
+            entry['reason'] = 'already in download list'
+        else:
+            entry['action'] = 'download'
+            entry['reason'] = 'not in download list'
+        RUN_REPORT.count('planned' if entry['action'] == 'download'
+                         else 'skipped')
+        entries.append(entry)
+
+    return entries
+
+
+def download_trailers_from_page(page_url, settings, hooks=None):
+    """Takes a page on the Apple Trailers website and downloads the trailer
+    for the movie on the page. Example URL:
+    http://trailers.apple.com/trailers/lions_gate/thehungergames/
+
+    If a PostDownloadHooks object is given, every downloaded file is passed to
+    it."""
+
+    logging.debug('Checking for files at %s', page_url)
+    trailer_urls = get_trailer_file_urls(page_url, settings['resolution'],
+                                         settings['video_types'],
+                                         settings['download_all_urls'])
+    download_trailer_files(trailer_urls, settings, hooks)
+
+
+def download_trailer_files(trailer_urls, settings, hooks=None, journal=None,
+                           pool=None):
+    """Download the given trailer files, skipping the ones that are already
+    in the list of downloaded files. If a RunJournal is given, the start and
+    end of each download is recorded in it.
+
+    If a ThreadPool is given, the files are downloaded by the pool, and a
+    list of the AsyncResults of the downloads is returned. Otherwise, the
+    files are downloaded one after another."""
+    with contextlib.closing(
+            load_download_history(settings['list_file'])) as history:
+        entries = get_download_plan_entries(trailer_urls, history,
+                                            settings['video_types'])
+
+    def download_entry(entry):
+        """Download a single file and record it in the journal."""
+        if journal:
+            journal.record_file_start(settings['download_dir'],
+                                      entry['filename'])
+        result = download_plan_entry(entry, settings, hooks)
+        if journal and result:
+            journal.record_file_result(entry['filename'], result)
+
+    pending = []
+    for entry in entries:
+        if entry['action'] != 'download':
+            logging.debug('*** File already downloaded, skipping: %s',
+                          entry['filename'])
+        elif pool:
+            pending.append(pool.apply_async(download_entry, (entry,)))
+        else:
+            download_entry(entry)
+    return pending
+
+
+# pylint: disable-next=too-many-instance-attributes
+class RunJournal(object):
+    """An append-only journal of a download run over the whole feed, which
+    lets an interrupted run continue where it stopped.
+
+    The journal records the list of movie pages in the feed, the trailer
+    files found on each page, and the start and end of each download with the
+    byte offset the download started at. Each record is a single JSON line
+    that is appended and flushed, but not synced. When a run is restarted
+    with a journal left by an interrupted run, the feed and the pages that
+    were already resolved are taken from the journal instead of being
+    fetched again; partially downloaded files are resumed from their ".part"
+    files. A ".part" file that is shorter than the offset its interrupted
+    download started at was changed outside of the run, so it is discarded
+    and the file is downloaded again. The journal is deleted when the run
+    finishes.
+
+    A journal written with a different resolution, video type, shard or base
+    URL setting is ignored.
+    """
+
+    def __init__(self, path, resolution, video_types, shard=None,
+                 base_url=None):
+        self.path = path
+        self.resolution = resolution
+        self.video_types = video_types
+        self.shard = shard
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.journal_file = None
+
+        self.page_urls = None
+        self.resolved_pages = {}
+        self.file_offsets = {}
+        self.load()
+
+    def load(self):
+        """Read the records of an interrupted run, if there are any."""
+        if not os.path.exists(self.path):
             return
 
-        if ex.code == 404:
-            logging.error("*** Error downloading file: file not found")
+        with io.open(self.path, mode='r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record may be incomplete if the process was
+                    # killed while writing it
+                    continue
+                self.apply_record(record)
+
+    def apply_record(self, record):
+        """Update the journal state with a record read from the file."""
+        if record['event'] == 'start':
+            if (record['resolution'] != self.resolution
+                    or record['video_types'] != self.video_types
+                    or record.get('shard') != self.shard
+                    or record.get('base_url') != self.base_url):
+                logging.debug("Ignoring journal written with other settings")
+                self.page_urls = None
+                self.resolved_pages = {}
+                return
+            self.page_urls = record['pages']
+        elif self.page_urls is None:
             return
+        elif record['event'] == 'page':
+            self.resolved_pages[record['url']] = [
+                TrailerFile(t['res'], t['title'], t['type'], t['url'])
+                for t in record['files']]
+        elif record['event'] == 'file_start':
+            self.file_offsets[record['filename']] = record['offset']
+        elif record['event'] == 'file_end':
+            self.file_offsets.pop(record['filename'], None)
 
-        logging.error("*** Error downloading file")
-        return
-    except URLError:
-        logging.error("*** Error downloading file")
+    def append(self, record):
+        """Append a record to the journal file."""
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            if self.journal_file is None:
+                # pylint: disable-next=consider-using-with
+                self.journal_file = open(self.path, 'ab')
+            self.journal_file.write(line.encode('utf-8'))
+            self.journal_file.flush()
+
+    def is_resuming(self):
+        """Returns true if the journal contains an interrupted run."""
+        return self.page_urls is not None
+
+    def start(self, page_urls):
+        """Record the start of a new run over the given movie pages."""
+        with self.lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+            # Start a new file, so that records of an older run are dropped
+            # pylint: disable-next=consider-using-with
+            self.journal_file = open(self.path, 'wb')
+        self.page_urls = page_urls
+        self.resolved_pages = {}
+        self.append({
+            'event': 'start',
+            'resolution': self.resolution,
+            'video_types': self.video_types,
+            'shard': self.shard,
+            'base_url': self.base_url,
+            'pages': page_urls,
+        })
+
+    def record_page(self, page_url, trailer_files):
+        """Record the trailer files found on a movie page."""
+        self.resolved_pages[page_url] = trailer_files
+        self.append({
+            'event': 'page',
+            'url': page_url,
+            'files': [dict(t) for t in trailer_files],
+        })
+
+    def record_file_start(self, destdir, filename):
+        """Record that the download of a file starts, along with the number
+        of bytes that were already downloaded. If the interrupted run had
+        started the file at a later offset than the size of its ".part" file,
+        the ".part" file is removed, so the file is downloaded again."""
+        part_path = os.path.join(destdir, filename + u'.part')
+        offset = 0
+        if os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+        if filename in self.file_offsets:
+            if offset < self.file_offsets[filename]:
+                logging.debug("  Partial download was changed since the "
+                              "interrupted run, restarting it")
+                os.remove(part_path)
+                offset = 0
+            else:
+                logging.debug("  Resuming interrupted download at byte %s",
+                              offset)
+        self.append({'event': 'file_start', 'filename': filename,
+                     'offset': offset})
+
+    def record_file_result(self, filename, result):
+        """Record the end of the download of a file."""
+        self.append({'event': 'file_end', 'filename': filename,
+                     'ok': result.ok, 'bytes': result.bytes_downloaded})
+
+    def finish(self):
+        """Delete the journal after the run has finished."""
+        with self.lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_journal_path(settings):
+    """Return the path of the run journal, which is stored next to the list
+    of downloaded files. Each shard has its own journal, since the processes
+    of several shards share the list."""
+    if 'shard' in settings:
+        index, count = parse_shard(settings['shard'])
+        return u'{}.{}-of-{}.journal'.format(settings['list_file'], index,
+                                             count)
+    return settings['list_file'] + u'.journal'
+
+
+def get_max_workers(settings):
+    """Return the largest number of HTTP requests that may be in flight at
+    the same time, which is also the size of the worker thread pools, so that
+    there are enough threads when HTTP_CONCURRENCY raises its limit."""
+    workers = int(settings.get('workers', 4))
+    return max(workers, int(settings.get('max_workers', workers)))
+
+
+def resolve_page(page_url, settings):
+    """Get the trailer files of a movie page of the current run, and count
+    the page and the time it took in RUN_REPORT."""
+    logging.debug('Checking for files at %s', page_url)
+    start = time.time()
+    trailer_files = get_trailer_file_urls(page_url, settings['resolution'],
+                                          settings['video_types'],
+                                          settings['download_all_urls'])
+    RUN_REPORT.add_page(time.time() - start)
+    return trailer_files
+
+
+def download_feed(page_urls, settings, hooks=None, journal=None):
+    """Download the trailers of all of the given movie pages. The pages are
+    resolved in the background while the files of the pages that are already
+    resolved are downloaded by a pool of worker threads. The number of page
+    fetches and downloads running at the same time is limited by
+    HTTP_CONCURRENCY.
+
+    If a RunJournal of an interrupted run is given, the pages that were
+    already resolved in that run are taken from the journal."""
+    workers = get_max_workers(settings)
+    pool = ThreadPool(workers)
+    pending = []
+    queued_files = set()
+
+    def queue_downloads(trailer_urls):
+        """Queue the downloads of a page's files that aren't queued yet,
+        e.g. because a page is listed twice in the feed."""
+        new_files = [t for t in trailer_urls if t['url'] not in queued_files]
+        queued_files.update(t['url'] for t in new_files)
+        pending.extend(download_trailer_files(new_files, settings, hooks,
+                                              journal, pool))
+
+    try:
+        pending_urls = page_urls
+        if journal:
+            pending_urls = [u for u in page_urls
+                            if u not in journal.resolved_pages]
+            for page_url in page_urls:
+                if page_url in journal.resolved_pages:
+                    RUN_REPORT.count('movies')
+                    queue_downloads(journal.resolved_pages[page_url])
+
+        for page_url, trailer_urls in iter_pool_results(
+                lambda url: (url, resolve_page(url, settings)),
+                pending_urls, workers):
+            if journal:
+                journal.record_page(page_url, trailer_urls)
+            queue_downloads(trailer_urls)
+
+        for result in pending:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_download_plan(page_urls, settings):
+    """Resolve the trailer files on all of the given movie pages and return a
+    plan of which files should be downloaded, without downloading anything.
+    The movie pages and the file sizes are fetched concurrently by a pool of
+    worker threads. The sizes are asked from the server the files would be
+    downloaded from, e.g. a mirror given as base_url."""
+    history = load_download_history(settings['list_file'])
+
+    pool = ThreadPool(get_max_workers(settings))
+    try:
+        entries = []
+        for trailer_urls in pool.imap(
+                lambda url: resolve_page(url, settings), page_urls):
+            entries.extend(
+                get_download_plan_entries(trailer_urls, history,
+                                          settings['video_types']))
+
+        download_entries = [e for e in entries if e['action'] == 'download']
+        sizes = pool.map(get_remote_file_size,
+                         [get_file_url(e['url'], settings)
+                          for e in download_entries])
+    finally:
+        pool.close()
+        pool.join()
+        history.close()
+
+    for entry in entries:
+        entry['size'] = None
+    for entry, size in zip(download_entries, sizes):
+        entry['size'] = size
+
+    return {
+        'resolution': settings['resolution'],
+        'video_types': settings['video_types'],
+        'files': entries,
+    }
+
+
+def write_download_plan(plan, plan_path):
+    """Write the download plan to the given path as JSON. If the path is "-",
+    the plan is written to stdout."""
+    if plan_path == '-':
+        json.dump(plan, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
         return
 
-    # Buffer 1MB at a time
-    chunk_size = 1024 * 1024
+    with open(plan_path, 'wb') as plan_file:
+        plan_file.write(json.dumps(plan, indent=2,
+                                   sort_keys=True).encode('utf-8'))
+
+
+def load_download_plan(plan_path):
+    """Load a download plan that was written by write_download_plan. Raises a
+    ValueError if the file does not contain a valid plan."""
+    with io.open(plan_path, mode='r', encoding='utf-8') as plan_file:
+        plan = json.load(plan_file)
+
+    if not isinstance(plan, dict) or 'files' not in plan:
+        raise ValueError("'{}' is not a download plan".format(plan_path))
+
+    return plan
+
+
+def execute_download_plan(plan, settings, hooks=None):
+    """Download all of the files in the given plan that are marked for
+    download. Files in the plan are not checked against the download list
+    again, so that exactly the planned files are downloaded.
+
+    If the shard setting is given, only the files in this process's shard of
+    the plan are downloaded. The files are downloaded by a pool of worker
+    threads, and the number of downloads running at the same time is limited
+    by HTTP_CONCURRENCY."""
+    entries = [e for e in plan['files'] if e['action'] == 'download']
+    if 'shard' in settings:
+        entries = [e for e in entries
+                   if url_in_shard(e['url'], settings['shard'])]
+
+    pool = ThreadPool(get_max_workers(settings))
+    try:
+        results = pool.map(
+            lambda entry: download_plan_entry(entry, settings, hooks),
+            entries)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def download_plan_entry(entry, settings, hooks=None):
+    """Download a single file from a download plan and record it in the list
+    of downloaded files.
+
+    When several processes share a download directory (the shard setting is
+    given), the file is claimed first, and it is skipped if another process
+    holds the claim or has already recorded the file.
+
+    Returns the DownloadResult, or None if the file was skipped. Files that
+    failed to download are not recorded, so they are retried on the next
+    run."""
+    claim_token = None
+    if 'shard' in settings:
+        claim_token = claim_file(settings['download_dir'], entry['filename'])
+        if not claim_token:
+            logging.debug('*** File claimed by another process, skipping: %s',
+                          entry['filename'])
+            return None
+
+        # Another process may have finished the file after we read the list
+        with contextlib.closing(
+                load_download_history(settings['list_file'])) as history:
+            recorded = entry['filename'] in history
+        if recorded:
+            release_file_claim(settings['download_dir'], entry['filename'],
+                               claim_token)
+            logging.debug('*** File already downloaded, skipping: %s',
+                          entry['filename'])
+            return None
+
+    try:
+        logging.info('Downloading %s: %s', entry['type'], entry['filename'])
+        start = time.time()
+        result = download_trailer_file(get_file_url(entry['url'], settings),
+                                       settings['download_dir'],
+                                       entry['filename'])
+        RUN_REPORT.record_download(entry['url'], result, time.time() - start)
+        if result.ok:
+            record_downloaded_file(entry['filename'], settings['list_file'])
+            FILENAME_INDEX.release(entry['filename'], entry['url'])
+    finally:
+        if claim_token:
+            release_file_claim(settings['download_dir'], entry['filename'],
+                               claim_token)
+
+    if hooks and result.ok:
+        hooks.submit(entry, result.file_path)
+
+    return result
+
+
+class PostDownloadHooks(object):
+    """Runs post-download hooks, like remuxing a file or notifying a media
+    server, in a bounded pool of worker threads while other files are still
+    being downloaded.
+
+    Each hook is a callable that takes the trailer dict and the path of the
+    downloaded file. The hooks for one file are run in order. At most
+    max_pending files can be waiting for their hooks; when that limit is
+    reached, submit() blocks, which pauses the downloads until the hooks have
+    caught up.
+    """
+
+    def __init__(self, hooks, workers=2, max_pending=None):
+        self.hooks = hooks
+        self.pool = ThreadPool(workers)
+        self.pending = threading.BoundedSemaphore(max_pending or workers * 2)
+
+    def submit(self, trailer, file_path):
+        """Queue the hooks to be run for a downloaded file."""
+        # Released by run_hooks once the hooks have finished
+        # pylint: disable-next=consider-using-with
+        self.pending.acquire()
+        self.pool.apply_async(self.run_hooks, (trailer, file_path))
+
+    def run_hooks(self, trailer, file_path):
+        """Run all of the hooks for a downloaded file."""
+        try:
+            for hook in self.hooks:
+                try:
+                    with TRACE.span('post_download_hook', 'hook',
+                                    {'arg': file_path}):
+                        hook(trailer, file_path)
+                except Exception as ex:  # pylint: disable=broad-except
+                    logging.error("*** Error in post-download hook for %s: %s",
+                                  file_path, ex)
+        finally:
+            self.pending.release()
+
+    def close(self):
+        """Wait for all queued hooks to finish."""
+        self.pool.close()
+        self.pool.join()
+
+
+def make_command_hook(command):
+    """Return a post-download hook that runs the given shell command. The
+    trailer info is passed to the command in the TRAILER_FILE, TRAILER_TITLE,
+    TRAILER_TYPE, TRAILER_RES and TRAILER_URL environment variables, and as
+    JSON on stdin."""
+
+    def command_hook(trailer, file_path):
+        """Run the command for a single downloaded file."""
+        env = dict(os.environ)
+        hook_vars = {
+            'TRAILER_FILE': file_path,
+            'TRAILER_TITLE': trailer['title'],
+            'TRAILER_TYPE': trailer['type'],
+            'TRAILER_RES': trailer['res'],
+            'TRAILER_URL': trailer['url'],
+        }
+        for name, value in hook_vars.items():
+            if sys.version_info[0] < 3:
+                value = value.encode('utf-8')
+            env[name] = value
+
+        # Popen isn't a context manager on Python 2
+        # pylint: disable-next=consider-using-with
+        process = subprocess.Popen(command, shell=True, env=env,
+                                   stdin=subprocess.PIPE)
+        process.communicate(json.dumps(trailer).encode('utf-8'))
+        if process.returncode != 0:
+            logging.error("*** Post-download command failed for %s with exit "
+                          "code %s", file_path, process.returncode)
+
+    return command_hook
+
+
+def parse_shard(shard):
+    """Parse a shard setting of the form "INDEX/COUNT", for example "0/3",
+    into a tuple of integers. Raises a ValueError if the value is invalid."""
+    parts = shard.split('/')
+    if (len(parts) != 2 or not parts[0].strip().isdigit()
+            or not parts[1].strip().isdigit()):
+        raise ValueError("invalid shard. The format is INDEX/COUNT, e.g. 0/3")
+
+    index = int(parts[0])
+    count = int(parts[1])
+    if count < 1 or index >= count:
+        raise ValueError("invalid shard. The index must be less than the "
+                         "count")
+
+    return (index, count)
+
+
+def get_url_shard(url, shard_count):
+    """Map a URL to one of shard_count shards. The shard only depends on the
+    path of the URL, so it is the same on every machine and every run."""
+    path = get_url_path(url).encode('utf-8')
+    return (zlib.crc32(path) & 0xffffffff) % shard_count
+
+
+def url_in_shard(url, shard):
+    """Returns true if the URL belongs to the shard given as "INDEX/COUNT"."""
+    index, count = parse_shard(shard)
+    return get_url_shard(url, count) == index
+
 
-    try:
-        if resume_download:
-            logging.debug("  Resuming file %s", file_path)
-            with open(file_path, 'ab') as local_file_handle:
-                shutil.copyfileobj(server_file_handle, local_file_handle,
-                                   chunk_size)
-        else:
-            logging.debug("  Saving file to %s", file_path)
-            with open(file_path, 'wb') as local_file_handle:
-                shutil.copyfileobj(server_file_handle, local_file_handle,
-                                   chunk_size)
-    except socket.error as ex:
-        logging.error("*** Network error while downloading file: %s", ex)
-        return
+# Claims older than this are assumed to be left over from a crashed process
+CLAIM_TIMEOUT_SECONDS = 6 * 60 * 60
 
 
-def download_trailers_from_page(page_url, settings):
-    """Takes a page on the Apple Trailers website and downloads the trailer
-    for the movie on the page. Example URL:
-    http://trailers.apple.com/trailers/lions_gate/thehungergames/"""
+def get_claim_path(destdir, filename):
+    """Return the path of the claim marker file for a downloaded file."""
+    return os.path.join(destdir, filename + u'.claim')
 
-    logging.debug('Checking for files at %s', page_url)
-    trailer_urls = get_trailer_file_urls(page_url, settings['resolution'],
-                                         settings['video_types'],
-                                         settings['download_all_urls'])
-    downloaded_files = get_downloaded_files(settings['list_file'])
 
-    for trailer_url in trailer_urls:
-        trailer_file_name = get_trailer_filename(trailer_url['title'],
-                                                 trailer_url['type'],
-                                                 trailer_url['res'])
-        already_downloaded = (
-            file_already_downloaded(downloaded_files, trailer_url['title'],
-                                    trailer_url['type'], trailer_url['res'],
-                                    settings['video_types'])
-        )
+def claim_file(destdir, filename):
+    """Atomically claim a file in the download directory, so that no other
+    process downloads it at the same time, even when the directory is shared
+    between machines. The claim is a marker file created with
+    take_marker_file. Returns the token of the claim, which is needed to
+    release it, or None if another process holds the claim."""
+    return take_marker_file(get_claim_path(destdir, filename),
+                            CLAIM_TIMEOUT_SECONDS)
 
-        if not already_downloaded:
-            logging.info('Downloading %s: %s', trailer_url['type'],
-                         trailer_file_name)
-            download_trailer_file(trailer_url['url'], settings['download_dir'],
-                                  trailer_file_name)
-            record_downloaded_file(trailer_file_name, settings['list_file'])
-        else:
-            logging.debug('*** File already downloaded, skipping: %s',
-                          trailer_file_name)
+
+def release_file_claim(destdir, filename, token):
+    """Remove the claim for the given file, if it is still the claim with the
+    given token."""
+    remove_marker_file(get_claim_path(destdir, filename), token)
 
 
 def clean_movie_title(title):
@@ -370,9 +3050,70 @@ def validate_settings(settings):
     if not os.path.exists(os.path.dirname(settings['list_file'])):
         raise ValueError('the list file directory must be a valid path')
 
+    validate_optional_settings(settings)
+
     return True
 
 
+# The valid values of optional settings that are one of a fixed set of values
+CHOICE_SETTINGS = {
+    'progress': ['auto', 'tty', 'json', 'none'],
+    'case_insensitive_filenames': ['auto', 'true', 'false'],
+}
+
+# Optional settings that must be numbers, with the smallest valid value and
+# the error message for invalid values
+NUMBER_SETTINGS = {
+    'workers': (1, 'the number of workers must be a positive integer'),
+    'max_workers': (1, 'the maximum number of workers must be a positive '
+                    'integer'),
+    'hook_workers': (1, 'the number of hook workers must be a positive '
+                     'integer'),
+    'dns_ttl': (0, 'the DNS cache TTL must be a number of seconds'),
+    'repeat': (0, 'the repeat interval must be a number of seconds'),
+    'serve': (0, 'the mirror port must be a number'),
+    'runs': (1, 'the number of runs must be a positive integer'),
+}
+
+
+def validate_optional_settings(settings):
+    """Validate the settings that don't need to be given. Raises a ValueError
+    if any of them is invalid."""
+    for name, valid_values in CHOICE_SETTINGS.items():
+        if str(settings.get(name, 'auto')).lower() not in valid_values:
+            raise ValueError("invalid {}. Valid values: {}".format(
+                name, ', '.join(valid_values)))
+
+    for name, (minimum, message) in NUMBER_SETTINGS.items():
+        if name in settings:
+            value = str(settings[name])
+            if not value.isdigit() or int(value) < minimum:
+                raise ValueError(message)
+
+    if 'shard' in settings:
+        parse_shard(settings['shard'])
+
+    if not settings.get('base_url', APPLE_BASE_URL).startswith(
+            ('http://', 'https://')):
+        raise ValueError('the base URL must start with http:// or https://')
+
+    if 'record' in settings and 'replay' in settings:
+        raise ValueError('HTTP responses cannot be recorded and replayed at '
+                         'the same time')
+
+    if 'plan' in settings and 'execute_plan' in settings:
+        raise ValueError('a plan cannot be created and executed at the same '
+                         'time')
+
+
+def get_config_paths(config_path):
+    """Return the paths at which a config file is looked for, in order."""
+    return [
+        config_path,
+        os.path.join(os.path.expanduser('~'), '.trailers.cfg'),
+    ]
+
+
 def get_config_values(config_path, defaults):
     """Get the script's configuration values and return them in a dict
 
@@ -383,25 +3124,22 @@ def get_config_values(config_path, defaults):
     config = ConfigParser(defaults)
     config_values = config.defaults()
 
-    config_paths = [
-        config_path,
-        os.path.join(os.path.expanduser('~'), '.trailers.cfg'),
-    ]
-
     config_file_found = False
-    for path in config_paths:
+    for path in get_config_paths(config_path):
         if os.path.exists(path):
             config_file_found = True
             config.read(path)
             config_values = config.defaults()
             break
 
+    # Store the URLs as a set, because every trailer file is checked against
+    # them
     if config_values.get('download_all_urls', ''):
-        config_values['download_all_urls'] = (
-            [get_url_path(s) for
-             s in config_values['download_all_urls'].split(',')])
+        config_values['download_all_urls'] = frozenset(
+            get_url_path(s) for
+            s in config_values['download_all_urls'].split(','))
     else:
-        config_values['download_all_urls'] = []
+        config_values['download_all_urls'] = frozenset()
 
     if not config_file_found:
         logging.info('Config file not found. Using default values.')
@@ -423,6 +3161,15 @@ def get_settings():
         'output_level': 'debug',
         'resolution': '720',
         'video_types': 'single_trailer',
+        'workers': '4',
+        'max_workers': '16',
+        'hook_workers': '2',
+        'progress': 'auto',
+        'dns_ttl': '300',
+        'repeat': '0',
+        'runs': '10',
+        'case_insensitive_filenames': 'auto',
+        'base_url': APPLE_BASE_URL,
     }
 
     args = get_command_line_arguments()
@@ -446,7 +3193,66 @@ def get_settings():
 
     validate_settings(settings)
 
-    return settings
+    return LiveSettings(settings, defaults, args)
+
+
+# The settings that can be changed in the config file while the script runs
+RELOADABLE_SETTINGS = ['resolution', 'video_types', 'download_all_urls',
+                       'output_level']
+
+
+class LiveSettings(dict):
+    """The settings of a long-running process, which can pick up changes to
+    the config file without a restart.
+
+    reload() checks the modification time of the config files first, so it
+    only costs a stat call per file when nothing changed. When a file did
+    change, only the config file is parsed again, and the new values of the
+    RELOADABLE_SETTINGS that were not given on the command line are
+    validated and applied. Since the object is the settings dict itself,
+    code that reads the settings sees the new values immediately.
+    """
+
+    def __init__(self, settings, defaults, args):
+        dict.__init__(self, settings)
+        self.defaults = defaults
+        self.args = args
+        self.config_mtimes = self.get_config_mtimes()
+
+    def get_config_mtimes(self):
+        """Return the modification times of the possible config files."""
+        mtimes = []
+        for path in get_config_paths(self['config_path']):
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def reload(self):
+        """Apply the changes in the config file, if there are any. Returns the
+        names of the settings that changed. Raises an Error or ValueError if
+        the changed config file is invalid, in which case the settings are
+        not changed."""
+        mtimes = self.get_config_mtimes()
+        if mtimes == self.config_mtimes:
+            return []
+        self.config_mtimes = mtimes
+
+        config = get_config_values(self['config_path'], self.defaults)
+        new_settings = dict(self)
+        for name in RELOADABLE_SETTINGS:
+            if name in config and name not in self.args:
+                new_settings[name] = config[name]
+        validate_settings(new_settings)
+
+        changed = [name for name in RELOADABLE_SETTINGS
+                   if new_settings.get(name) != self.get(name)]
+        for name in changed:
+            logging.info("Setting %s changed to %s", name, new_settings[name])
+            self[name] = new_settings[name]
+
+        return changed
 
 
 def get_command_line_arguments():
@@ -518,6 +3324,140 @@ def get_command_line_arguments():
         '"debug", "downloads", and "error".'
     )
 
+    parser.add_argument(
+        '--workers',
+        action='store',
+        dest='workers',
+        help='The number of movie pages and files that are fetched at ' +
+        'the same time when a run starts. The number is adapted to the ' +
+        'measured throughput while the run goes on. Defaults to 4.'
+    )
+
+    parser.add_argument(
+        '--max-workers',
+        action='store',
+        dest='max_workers',
+        help='The largest number of movie pages and files that are ' +
+        'fetched at the same time when the throughput keeps going up. ' +
+        'Defaults to 16.'
+    )
+
+    parser.add_argument(
+        '--plan',
+        action='store',
+        dest='plan',
+        help='Do not download anything, but write the list of files that ' +
+        'would be downloaded or skipped to the given path as JSON. Use "-" ' +
+        'to write the plan to stdout.'
+    )
+
+    parser.add_argument(
+        '--execute-plan',
+        action='store',
+        dest='execute_plan',
+        help='Download exactly the files in the given plan file, which was ' +
+        'created with --plan.'
+    )
+
+    parser.add_argument(
+        '--shard',
+        action='store',
+        dest='shard',
+        help='Only download the movies in one shard of the list, given as ' +
+        'INDEX/COUNT, e.g. "0/3". Use this to split the downloads between ' +
+        'several machines that share a download directory.'
+    )
+
+    parser.add_argument(
+        '--post-download-command',
+        action='store',
+        dest='post_download_command',
+        help='A shell command to run after each file has been downloaded. ' +
+        'The path of the file is in the TRAILER_FILE environment variable.'
+    )
+
+    parser.add_argument(
+        '--progress',
+        action='store',
+        dest='progress',
+        help='How to report the progress of downloads. Valid options are ' +
+        '"auto", "tty", "json", and "none". "auto" shows a status line if ' +
+        'the output is a terminal. Defaults to "auto".'
+    )
+
+    parser.add_argument(
+        '--record',
+        action='store',
+        dest='record',
+        help='Record all HTTP responses into the given archive file, so ' +
+        'that the run can be replayed later with --replay. Video files are ' +
+        'cut to 1MB in the archive.'
+    )
+
+    parser.add_argument(
+        '--replay',
+        action='store',
+        dest='replay',
+        help='Replay the HTTP responses from an archive file created with ' +
+        '--record, without using the network.'
+    )
+
+    parser.add_argument(
+        '--repeat',
+        action='store',
+        dest='repeat',
+        help='Keep running and check for new trailers every REPEAT ' +
+        'seconds. Changes to the resolution, video types, download_all_urls ' +
+        'and output level in the config file are applied without a restart.'
+    )
+
+    parser.add_argument(
+        'command',
+        nargs='?',
+        choices=['download', 'stats', 'migrate-history'],
+        help='"download" (the default) downloads new trailers. "stats" ' +
+        'shows statistics about the last runs, like the average ' +
+        'throughput and the slowest hosts. "migrate-history" builds an ' +
+        'index of the list of downloaded files, which makes checking large ' +
+        'lists faster.'
+    )
+
+    parser.add_argument(
+        '--runs',
+        action='store',
+        dest='runs',
+        help='The number of past runs that "stats" summarizes. Defaults ' +
+        'to 10.'
+    )
+
+    parser.add_argument(
+        '--profile',
+        action='store',
+        dest='profile',
+        help='Profile the run and write the cProfile data to the given ' +
+        'path, a Chrome trace of the page fetches and downloads on all ' +
+        'workers to the path plus ".trace.json", and a report of the ' +
+        'slowest functions to the path plus ".txt".'
+    )
+
+    parser.add_argument(
+        '--base-url',
+        action='store',
+        dest='base_url',
+        help='The URL of the trailers site. Set this to the URL of a mirror ' +
+        'started with --serve to download through the mirror. Defaults to ' +
+        '"http://trailers.apple.com".'
+    )
+
+    parser.add_argument(
+        '--serve',
+        action='store',
+        dest='serve',
+        help='Run a mirror of the trailers site on the given port. Other ' +
+        'instances of the script can use it with --base-url, so each ' +
+        'trailer is only downloaded from Apple once.'
+    )
+
     results = parser.parse_args()
     args = {
         'config_path': results.config,
@@ -527,6 +3467,21 @@ def get_command_line_arguments():
         'resolution': results.resolution,
         'video_types': results.types,
         'output_level': results.output,
+        'workers': results.workers,
+        'max_workers': results.max_workers,
+        'plan': results.plan,
+        'execute_plan': results.execute_plan,
+        'shard': results.shard,
+        'post_download_command': results.post_download_command,
+        'progress': results.progress,
+        'record': results.record,
+        'replay': results.replay,
+        'repeat': results.repeat,
+        'command': results.command,
+        'runs': results.runs,
+        'profile': results.profile,
+        'base_url': results.base_url,
+        'serve': results.serve,
     }
 
     # Remove all pairs that were not set on the command line.
@@ -554,17 +3509,465 @@ def configure_logging(output_level):
     logging.getLogger().setLevel(log_level)
 
 
+def get_accept_encoding():
+    """Return the Accept-Encoding header for metadata requests. Brotli is only
+    accepted if the brotli module is installed."""
+    encodings = ['gzip', 'deflate']
+    try:
+        # pylint: disable=import-outside-toplevel,unused-import
+        import brotli  # noqa: F401
+        encodings.insert(0, 'br')
+    except ImportError:
+        pass
+
+    return ', '.join(encodings)
+
+
+def get_decompressor(content_encoding):
+    """Return a function that decompresses the next chunk of a response with
+    the given Content-Encoding, and a function that returns the rest of the
+    data at the end. Returns (None, None) for uncompressed responses, and
+    raises a ValueError for unknown encodings."""
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return (None, None)
+
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        # Automatically detects the gzip or zlib header
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        return (decompressor.decompress, decompressor.flush)
+
+    if encoding == 'br':
+        # pylint: disable=import-outside-toplevel,import-error
+        import brotli
+        decompressor = brotli.Decompressor()
+        decompress = getattr(decompressor, 'decompress', None)
+        return (decompress or decompressor.process, lambda: b'')
+
+    raise ValueError("unsupported Content-Encoding: {}".format(encoding))
+
+
+def read_decompressed(response, chunk_size=64 * 1024):
+    """Read a whole response, decompressing it while it is read. Returns the
+    decompressed body and the number of bytes that were transferred."""
+    decompress, flush = get_decompressor(
+        response.info().get('Content-Encoding'))
+
+    chunks = []
+    compressed_size = 0
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        compressed_size += len(chunk)
+        chunks.append(decompress(chunk) if decompress else chunk)
+
+    if flush:
+        chunks.append(flush())
+
+    return (b''.join(chunks), compressed_size)
+
+
+@traced('fetch')
 def load_json_from_url(url):
     """Takes a URL and returns a Python dict representing the JSON of the
     URL's contents. If there is an error fetching the URL or invalid JSON is
     returned, an empty dict is returned."""
+    req = Request(url, None, {'Accept-Encoding': get_accept_encoding()})
+    with HTTP_CONCURRENCY.request() as http_request:
+        try:
+            response = HTTP_TRANSPORT.open(req)
+            raw_response, compressed_size = read_decompressed(response)
+            http_request.bytes = compressed_size
+            HTTP_TRANSPORT.record_metadata_transfer(compressed_size,
+                                                    len(raw_response))
+            return json.loads(raw_response.decode('utf-8'))
+        except (URLError, ValueError, socket.error, zlib.error) as ex:
+            http_request.set_error(ex)
+            logging.error("*** Error: could not load data from %s", url)
+            return {}
+
+
+# The site that trailers are downloaded from, unless base_url is set to a
+# mirror
+APPLE_BASE_URL = 'http://trailers.apple.com'
+
+# Paths on a mirror that are fetched from a different upstream host than
+# APPLE_BASE_URL
+MIRROR_UPSTREAMS = {
+    '/movies/': 'http://movietrailers.apple.com',
+}
+
+# How long a mirror serves the feed and movie pages before fetching them again
+MIRROR_METADATA_SECONDS = 10 * 60
+
+# The extensions of the video files that a mirror serves
+MIRROR_MEDIA_EXTENSIONS = ('.mov', '.m4v', '.mp4')
+
+
+def get_file_url(url, settings):
+    """Return the URL a trailer file should be downloaded from. When base_url
+    points to a mirror, the file is downloaded from the mirror."""
+    base_url = settings.get('base_url', APPLE_BASE_URL).rstrip('/')
+    if base_url == APPLE_BASE_URL:
+        return url
+
+    url_parts = urlparse(url)
+    return base_url + url_parts.path
+
+
+def get_mirror_upstream_url(path):
+    """Return the upstream URL for a path requested from a mirror."""
+    for prefix, upstream in MIRROR_UPSTREAMS.items():
+        if path.startswith(prefix):
+            return upstream + path
+    return APPLE_BASE_URL + path
+
+
+def parse_byte_range(byte_range, size):
+    """Parse a Range header for a file of the given size. Returns a tuple
+    (start, end) of the inclusive byte positions, or None if the whole file
+    should be sent. Raises a ValueError if the range can't be satisfied."""
+    if not byte_range or not byte_range.startswith('bytes='):
+        return None
+
+    first_range = byte_range[len('bytes='):].split(',')[0].strip()
+    start, _, end = first_range.partition('-')
+    if not start.isdigit() and not end.isdigit():
+        return None
+
+    if not start:
+        # A suffix range: the last N bytes
+        start = max(size - int(end), 0)
+        end = size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end.isdigit() else size - 1
+
+    if start >= size or start > end:
+        raise ValueError('unsatisfiable range: {}'.format(byte_range))
+
+    return (start, end)
+
+
+class TrailerMirror(object):
+    """A local mirror of the Apple Trailers site, which other instances of
+    this script can use as their base_url, so that each trailer only has to
+    be downloaded from Apple once.
+
+    The "Just Added" feed and the movie pages are cached in memory for
+    MIRROR_METADATA_SECONDS. Video files are downloaded with
+    download_trailer_file into the mirror directory the first time they are
+    requested, and served from there afterwards."""
+
+    def __init__(self, mirror_dir):
+        self.mirror_dir = mirror_dir
+        self.lock = threading.Lock()
+        self.metadata = {}
+        self.file_locks = {}
+
+    def get_metadata(self, path):
+        """Return the body of a JSON metadata file, fetching it from upstream
+        if it isn't cached. Raises an HTTPError or URLError if it can't be
+        fetched."""
+        now = time.time()
+        with self.lock:
+            cached = self.metadata.get(path)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        req = Request(get_mirror_upstream_url(path), None,
+                      {'Accept-Encoding': get_accept_encoding()})
+        with HTTP_CONCURRENCY.request() as http_request:
+            body, http_request.bytes = read_decompressed(
+                HTTP_TRANSPORT.open(req))
+
+        with self.lock:
+            self.metadata[path] = (now + MIRROR_METADATA_SECONDS, body)
+        return body
+
+    def get_media_file(self, path):
+        """Return the local path of a video file, downloading it from
+        upstream first if it isn't in the mirror yet. Returns None if the file
+        can't be downloaded."""
+        local_path = os.path.join(self.mirror_dir,
+                                  *path.strip('/').split('/'))
+        with self.lock:
+            file_lock = self.file_locks.setdefault(local_path,
+                                                   threading.Lock())
+
+        # Only one request downloads a file; the others wait for it
+        with file_lock:
+            if os.path.isfile(local_path):
+                return local_path
+
+            destdir, filename = os.path.split(local_path)
+            if not os.path.isdir(destdir):
+                os.makedirs(destdir)
+            logging.info("Mirroring %s", path)
+            result = download_trailer_file(get_mirror_upstream_url(path),
+                                           destdir, filename)
+            return local_path if result.ok else None
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    """Serves the files of the TrailerMirror set on the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve a GET request."""
+        self.handle_mirror_request(send_body=True)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """Serve a HEAD request."""
+        self.handle_mirror_request(send_body=False)
+
+    def handle_mirror_request(self, send_body):
+        """Serve a metadata or video file from the mirror."""
+        path = unquote(urlparse(self.path).path)
+        if (not path.startswith('/') or '..' in path.split('/') or
+                posixpath.normpath(path) != path):
+            self.send_error(400)
+            return
+
+        mirror = self.server.mirror
+        if path.endswith('.json'):
+            try:
+                body = mirror.get_metadata(path)
+            except HTTPError as ex:
+                self.send_error(ex.code)
+                return
+            except (URLError, socket.error, ValueError, zlib.error):
+                self.send_error(502)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+
+        if not path.lower().endswith(MIRROR_MEDIA_EXTENSIONS):
+            self.send_error(404)
+            return
+
+        local_path = mirror.get_media_file(path)
+        if local_path is None:
+            self.send_error(502)
+            return
+        self.send_media_file(local_path, send_body)
+
+    def send_media_file(self, local_path, send_body):
+        """Send a video file, or the requested byte range of it."""
+        size = os.path.getsize(local_path)
+        try:
+            byte_range = parse_byte_range(self.headers.get('Range'), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = byte_range or (0, size - 1)
+        length = max(end - start + 1, 0)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'video/quicktime')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(length))
+        if byte_range:
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, end, size))
+        self.end_headers()
+
+        if send_body:
+            with open(local_path, 'rb') as local_file:
+                send_file_range(self.wfile, self.connection, local_file,
+                                start, length)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("Mirror: %s - %s", self.address_string(),
+                      format % args)
+
+
+def send_file_range(wfile, connection, local_file, start, length):
+    """Send length bytes of a file, starting at start, to a client. Uses the
+    zero-copy os.sendfile where it is available."""
+    wfile.flush()
+    if hasattr(os, 'sendfile'):
+        offset = start
+        remaining = length
+        while remaining > 0:
+            sent = os.sendfile(connection.fileno(), local_file.fileno(),
+                               offset, min(remaining, 1024 * 1024 * 16))
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+        return
+
+    local_file.seek(start)
+    remaining = length
+    while remaining > 0:
+        chunk = local_file.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            break
+        wfile.write(chunk)
+        remaining -= len(chunk)
+
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server for a TrailerMirror."""
+
+    daemon_threads = True
+
+    def __init__(self, address, mirror):
+        HTTPServer.__init__(self, address, MirrorRequestHandler)
+        self.mirror = mirror
+
+
+def get_mirror_dir(settings):
+    """Return the directory in which a mirror stores video files."""
+    return os.path.join(settings['download_dir'], '.mirror')
+
+
+def serve_mirror(settings):
+    """Run a mirror server on the port given in the serve setting until the
+    process is stopped."""
+    mirror = TrailerMirror(get_mirror_dir(settings))
+    server = MirrorServer(('', int(settings['serve'])), mirror)
+    logging.info("Serving a mirror of %s on port %s", APPLE_BASE_URL,
+                 settings['serve'])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def get_page_urls(settings):
+    """Return the list of movie page URLs that should be checked for new
+    trailers. This is either the single page given on the command line or all
+    of the pages in the "Just Added" feed."""
+    if 'page' in settings:
+        # The trailer page URL was passed in on the command line
+        return [settings['page']]
+
+    base_url = settings.get('base_url', APPLE_BASE_URL).rstrip('/')
+    just_added_url = base_url + '/trailers/home/feeds/just_added.json'
+    newest_trailers = load_json_from_url(just_added_url)
+
+    return [base_url + trailer['location'] for trailer in newest_trailers]
+
+
+def is_case_insensitive(settings):
+    """Returns true if filenames should be compared case-insensitively,
+    according to the case_insensitive_filenames setting. With "auto", this is
+    detected by probing the download directory."""
+    case_setting = settings.get('case_insensitive_filenames', 'auto').lower()
+    if case_setting == 'auto':
+        return is_case_insensitive_dir(settings['download_dir'])
+    return case_setting == 'true'
+
+
+def reload_settings(settings):
+    """Apply changes in the config file to the settings of a long-running
+    process. If the changed config file is invalid, the previous settings are
+    kept."""
+    try:
+        changed = settings.reload()
+    except MissingSectionHeaderError:
+        logging.error('Configuration file is missing a header section, '
+                      'keeping the previous settings')
+        return
+    except (Error, ValueError) as ex:
+        logging.error("Configuration error, keeping the previous settings: "
+                      "%s", ex)
+        return
+
+    if 'output_level' in changed:
+        configure_logging(settings['output_level'])
+
+
+def get_http_archive(settings):
+    """Return the HttpArchive for the record or replay setting, or None if
+    neither is given."""
+    if 'record' in settings:
+        return HttpArchive(settings['record'], 'record')
+    if 'replay' in settings:
+        return HttpArchive(settings['replay'], 'replay')
+    return None
+
+
+def get_progress_renderer(progress):
+    """Return the progress renderer for the given progress setting."""
+    progress = progress.lower()
+    if progress == 'auto':
+        progress = 'tty' if sys.stderr.isatty() else 'none'
+
+    if progress == 'tty':
+        renderer = TtyProgressRenderer()
+        for handler in logging.getLogger().handlers:
+            if getattr(handler, 'stream', None) is renderer.stream:
+                handler.addFilter(ProgressLineFilter(renderer))
+        return renderer
+    if progress == 'json':
+        return JsonProgressRenderer()
+    return None
+
+
+def log_http_metrics():
+    """Log the measurements and concurrency decisions of HTTP_CONCURRENCY."""
+    metrics = HTTP_CONCURRENCY.get_metrics()
+    logging.debug("")
+    logging.debug("HTTP requests: %s, throttled: %s, bytes: %s",
+                  metrics['requests'], metrics['throttled_requests'],
+                  metrics['bytes'])
+    for decision in metrics['decisions']:
+        logging.debug("    Concurrency limit %s: %s", decision['limit'],
+                      decision['reason'])
+
+    metrics = HTTP_TRANSPORT.get_metrics()
+    average_connect_time = 0.0
+    if metrics['connections']:
+        average_connect_time = (metrics['connect_time'] /
+                                metrics['connections'])
+    logging.debug("Connections: %s, setup time: %.3fs (average %.1fms), "
+                  "DNS cache hits: %s, misses: %s", metrics['connections'],
+                  metrics['connect_time'], average_connect_time * 1000,
+                  metrics['dns_cache_hits'], metrics['dns_cache_misses'])
+    logging.debug("Metadata transferred: %s bytes, uncompressed: %s bytes",
+                  metrics['metadata_compressed_bytes'],
+                  metrics['metadata_bytes'])
+
+
+def get_post_download_hooks(settings):
+    """Return a PostDownloadHooks object for the configured post-download
+    command, or None if no command is configured."""
+    if not settings.get('post_download_command'):
+        return None
+
+    command_hook = make_command_hook(settings['post_download_command'])
+    return PostDownloadHooks([command_hook],
+                             int(settings.get('hook_workers', 2)))
+
+
+def run_saved_plan(settings):
+    """Download the files of the plan given in the execute_plan setting."""
+    try:
+        plan = load_download_plan(settings['execute_plan'])
+    except (IOError, ValueError) as ex:
+        logging.error("*** Error: could not load plan: %s", ex)
+        return
+
+    hooks = get_post_download_hooks(settings)
     try:
-        response = urlopen(url)
-        str_response = response.read().decode('utf-8')
-        return json.loads(str_response)
-    except (URLError, ValueError):
-        logging.error("*** Error: could not load data from %s", url)
-        return {}
+        execute_download_plan(plan, settings, hooks)
+    finally:
+        if hooks:
+            hooks.close()
 
 
 def main():
@@ -586,6 +3989,32 @@ def main():
 
     configure_logging(settings['output_level'])
 
+    if 'profile' in settings:
+        run_profiled(run_with_settings, settings, settings['profile'])
+    else:
+        run_with_settings(settings)
+
+
+def run_with_settings(settings):
+    """Run the mode selected by the settings: the mirror, the stats, or
+    downloading, once or repeatedly."""
+    if 'serve' in settings:
+        HTTP_CONCURRENCY.configure(int(settings['workers']),
+                                   get_max_workers(settings))
+        HTTP_TRANSPORT.enable_fast_connections(int(settings['dns_ttl']))
+        serve_mirror(settings)
+        return
+
+    if settings.get('command') == 'stats':
+        reports = load_run_reports(get_run_history_path(settings),
+                                   int(settings['runs']))
+        write_run_stats(get_run_stats(reports))
+        return
+
+    if settings.get('command') == 'migrate-history':
+        migrate_history(settings['list_file'])
+        return
+
     logging.debug("Using configuration values:")
     logging.debug("Loaded configuration from %s", settings['config_path'])
     for name in sorted(settings):
@@ -594,19 +4023,166 @@ def main():
 
     logging.debug("")
 
-    # Do the download
-    if 'page' in settings:
-        # The trailer page URL was passed in on the command line
-        download_trailers_from_page(settings['page'], settings)
+    HTTP_TRANSPORT.enable_fast_connections(int(settings['dns_ttl']))
+    DOWNLOAD_PROGRESS.renderer = get_progress_renderer(settings['progress'])
+    try:
+        HTTP_TRANSPORT.archive = get_http_archive(settings)
+    except (IOError, ValueError, zipfile.BadZipfile) as ex:
+        logging.error("*** Error: could not open HTTP archive: %s", ex)
+        return
+
+    try:
+        while True:
+            RUN_REPORT.reset()
+            DOWNLOAD_PROGRESS.reset()
+            HTTP_CONCURRENCY.configure(int(settings['workers']),
+                                       get_max_workers(settings))
+            # Only shards that pick their own filenames share them
+            FILENAME_INDEX.build(settings['download_dir'],
+                                 is_case_insensitive(settings),
+                                 'shard' in settings and 'plan' not in settings
+                                 and 'execute_plan' not in settings)
+            try:
+                run_main_mode(settings)
+            finally:
+                log_http_metrics()
+            report = RUN_REPORT.to_dict()
+            log_run_report(report)
+            # Plans don't download anything, so their wall times would skew
+            # the averages of the stats command
+            if 'plan' not in settings:
+                save_run_report(report, settings)
+
+            interval = int(settings.get('repeat', 0))
+            if not interval:
+                break
+
+            logging.debug("Waiting %s seconds until the next run", interval)
+            time.sleep(interval)
+            reload_settings(settings)
+    finally:
+        if HTTP_TRANSPORT.archive:
+            HTTP_TRANSPORT.archive.close()
+            HTTP_TRANSPORT.archive = None
+
+
+def run_profiled(function, settings, profile_path):
+    """Call function(settings) under cProfile, with the TRACE recording
+    enabled. Threads started during the call are profiled too. Writes the
+    profile in the pstats format to profile_path, the trace in the Chrome
+    trace event format to profile_path + ".trace.json" and a text report with
+    the slowest functions and the wall and CPU time of the traced calls to
+    profile_path + ".txt"."""
+    thread_profiles = []
+    thread_profiles_lock = threading.Lock()
+
+    # pylint: disable=unused-argument
+    def start_thread_profile(frame, event, arg):
+        """Replace itself with a profiler for the new thread."""
+        thread_profile = cProfile.Profile()
+        try:
+            thread_profile.enable()
+        except ValueError:
+            # Since Python 3.12, one profiler sees all threads
+            sys.setprofile(None)
+            return
+        with thread_profiles_lock:
+            thread_profiles.append(thread_profile)
+
+    main_profile = cProfile.Profile()
+    TRACE.enable()
+    threading.setprofile(start_thread_profile)
+    try:
+        main_profile.runcall(function, settings)
+    finally:
+        threading.setprofile(None)
+        TRACE.disable()
+        try:
+            write_profile(main_profile, thread_profiles, profile_path)
+        except IOError as ex:
+            logging.error("*** Error: could not write profile: %s", ex)
+
+
+def write_profile(main_profile, thread_profiles, profile_path):
+    """Write the profile, trace and text report files of run_profiled."""
+    report_path = profile_path + u'.txt'
+    trace_path = profile_path + u'.trace.json'
+    # pstats writes native strings, which io.open doesn't accept on Python 2
+    # pylint: disable-next=unspecified-encoding
+    with open(report_path, 'w') as report_file:
+        stats = pstats.Stats(main_profile, stream=report_file)
+        for thread_profile in thread_profiles:
+            stats.add(thread_profile)
+        stats.dump_stats(profile_path)
+
+        report_file.write(format_span_stats(TRACE.get_span_stats()))
+        report_file.write('\nFunctions on all threads, by cumulative wall '
+                          'time:\n')
+        stats.sort_stats('cumulative').print_stats(40)
+
+    TRACE.write(trace_path)
+    logging.debug("Wrote profile to %s, trace to %s and report to %s",
+                  profile_path, trace_path, report_path)
+
+
+def format_span_stats(span_stats):
+    """Format the output of TraceRecorder.get_span_stats as a table. The
+    wait column is the wall time that was not spent on the CPU."""
+    lines = ['Traced calls on all threads, in seconds:',
+             '{:<28} {:<9} {:>7} {:>10} {:>10} {:>10}'.format(
+                 'function', 'category', 'calls', 'wall', 'cpu', 'wait')]
+    for name, category, calls, wall, cpu in span_stats:
+        if cpu is None:
+            cpu_text = wait_text = '-'
+        else:
+            cpu_text = '{:.3f}'.format(cpu)
+            wait_text = '{:.3f}'.format(max(wall - cpu, 0))
+        lines.append('{:<28} {:<9} {:>7} {:>10.3f} {:>10} {:>10}'.format(
+            name, category, calls, wall, cpu_text, wait_text))
+    return '\n'.join(lines) + '\n'
 
+
+def run_main_mode(settings):
+    """Run the plan, execute-plan or download mode, depending on the
+    settings."""
+    if 'execute_plan' in settings:
+        run_saved_plan(settings)
+        return
+
+    # Only runs over the whole feed are journaled
+    journal = None
+    if 'page' not in settings and 'plan' not in settings:
+        journal = RunJournal(get_journal_path(settings),
+                             settings['resolution'], settings['video_types'],
+                             settings.get('shard'), settings.get('base_url'))
+
+    if journal and journal.is_resuming():
+        logging.info("Resuming interrupted run from %s", journal.path)
+        page_urls = journal.page_urls
     else:
-        just_added_url = ('http://trailers.apple.com/trailers/'
-                          'home/feeds/just_added.json')
-        newest_trailers = load_json_from_url(just_added_url)
+        start = time.time()
+        page_urls = get_page_urls(settings)
+        RUN_REPORT.add_phase_time('discovery', time.time() - start)
+        if 'shard' in settings:
+            page_urls = [url for url in page_urls
+                         if url_in_shard(url, settings['shard'])]
+        if journal:
+            journal.start(page_urls)
+
+    if 'plan' in settings:
+        plan = get_download_plan(page_urls, settings)
+        write_download_plan(plan, settings['plan'])
+        return
+
+    hooks = get_post_download_hooks(settings)
+    try:
+        download_feed(page_urls, settings, hooks, journal)
+    finally:
+        if hooks:
+            hooks.close()
 
-        for trailer in newest_trailers:
-            url = 'http://trailers.apple.com' + trailer['location']
-            download_trailers_from_page(url, settings)
+    if journal:
+        journal.finish()
 
 
 if __name__ == '__main__':
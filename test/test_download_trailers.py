@@ -21,12 +21,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import copy
+import io
 import logging
 import os
 import pytest
 import shutil
+import socket
 import sys
 import tempfile
+import threading
+import zlib
 
 # Add the parent directory to the path so we can import the main script
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -41,8 +45,18 @@ except ImportError:
     from configparser import MissingSectionHeaderError
     from configparser import Error
 
+try:
+    # For Python 3.0 and later
+    from http.client import HTTPConnection
+    from urllib.error import HTTPError
+except ImportError:
+    # For Python 2
+    from httplib import HTTPConnection
+    from urllib2 import HTTPError
+
 TEST_DIR = test_dir = os.path.dirname(os.path.abspath(__file__))
 DOWNLOAD_LIST_FIXTURE_PATH = os.path.join(TEST_DIR, 'fixtures', 'download_list.txt')
+HTTP_ARCHIVE_FIXTURE_PATH = os.path.join(TEST_DIR, 'fixtures', 'http_archive.zip')
 
 SOME_CONFIG_DEFAULTS = {
     'download_dir': '/tmp/download',
@@ -62,6 +76,43 @@ SOME_VALID_SETTINGS = {
 REQUIRED_SETTINGS = ['resolution', 'download_dir', 'video_types', 'output_level', 'list_file']
 
 
+@pytest.fixture(autouse=True)
+def fresh_filename_index(monkeypatch):
+    """Don't let filenames reserved by one test collide with another test."""
+    monkeypatch.setattr(trailers, 'FILENAME_INDEX', trailers.FilenameIndex())
+
+
+class FakeResponse(io.BytesIO):
+    """A stand-in for the response object returned by urlopen."""
+
+    def __init__(self, body, code=200, headers=None):
+        io.BytesIO.__init__(self, body)
+        self.code = code
+        self.headers = headers if headers is not None else {'Content-Length': str(len(body))}
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+
+def fake_urlopen(responses, requests=None):
+    """Return a urlopen replacement that returns or raises the given
+    responses in order, and optionally records the requests it receives."""
+    responses = list(responses)
+
+    def urlopen(req, *args, **kwargs):
+        if requests is not None:
+            requests.append(req)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    return urlopen
+
+
 def test_map_res_to_apple_size_480():
     assert trailers.map_res_to_apple_size('480') == u'sd'
 
@@ -277,7 +328,7 @@ def test_get_trailer_filename_repeating_spaces():
 def test_get_config_values_no_config_file():
     missing_file_path = '/not/a/path/on/any/real/system/settings.cfg'
     settings = copy.deepcopy(SOME_CONFIG_DEFAULTS)
-    settings['download_all_urls'] = []
+    settings['download_all_urls'] = frozenset()
 
     assert trailers.get_config_values(missing_file_path, SOME_CONFIG_DEFAULTS) == settings
 
@@ -285,7 +336,7 @@ def test_get_config_values_no_config_file():
 def test_get_config_values_empty_config_file():
     empty_config_file = os.path.join(TEST_DIR, 'fixtures', 'settings', 'empty_settings.cfg')
     settings = copy.deepcopy(SOME_CONFIG_DEFAULTS)
-    settings['download_all_urls'] = []
+    settings['download_all_urls'] = frozenset()
 
     assert trailers.get_config_values(empty_config_file, SOME_CONFIG_DEFAULTS) == settings
 
@@ -298,10 +349,10 @@ def test_get_config_values_normal_config_file():
         'resolution': '1080',
         'video_types': 'all',
         'output_level': 'error',
-        'download_all_urls': [
+        'download_all_urls': frozenset([
             '/trailers/one',
             '/trailers/two',
-        ]
+        ])
     }
 
     assert trailers.get_config_values(empty_config_file, SOME_CONFIG_DEFAULTS) == config_values
@@ -440,15 +491,1510 @@ def test_clean_url_without_trailing_slash():
 
     assert trailers.get_url_path(orig_url) == "/path/film"
 
-# def test_get_trailer_file_urls_invalid_domain():
-#     urls = trailers.get_trailer_file_urls("http://www.Norkm3cHedUNPmL7vMALFaYUp4o7jcLF9KTmwTAMPzNNoyxp.com/test", "480", ["all"], [])
-#     assert not urls
 
-# def test_get_trailer_file_urls_invalid_response():
-#     urls = trailers.get_trailer_file_urls("http://www.example.com/test", "480", ["all"], [])
-#     assert not urls
+@pytest.fixture
+def replay_transport(monkeypatch):
+    """Answer HTTP requests from the recorded archive in the fixtures, without
+    using the network."""
+    transport = trailers.HttpTransport()
+    transport.archive = trailers.HttpArchive(HTTP_ARCHIVE_FIXTURE_PATH, 'replay')
+    monkeypatch.setattr(trailers, 'HTTP_TRANSPORT', transport)
+    yield transport
+    transport.archive.close()
+
+
+def test_get_trailer_file_urls_invalid_domain(replay_transport):
+    urls = trailers.get_trailer_file_urls("http://www.Norkm3cHedUNPmL7vMALFaYUp4o7jcLF9KTmwTAMPzNNoyxp.com/test", "480", ["all"], [])
+    assert not urls
+
+
+def test_get_trailer_file_urls_invalid_response(replay_transport):
+    urls = trailers.get_trailer_file_urls("http://www.example.com/test", "480", ["all"], [])
+    assert not urls
+
+
+def test_get_trailer_file_urls_404(replay_transport):
+    urls = trailers.get_trailer_file_urls("https://definingterms.com/random_url_XHNcTCAwihjCRoxV7igg9gwk", "480", ["all"], [])
+    assert not urls
+
+
+def test_get_trailer_file_urls_replay(replay_transport):
+    urls = trailers.get_trailer_file_urls("http://trailers.apple.com/trailers/universal/thesnowman/", "720", "trailers", [])
+
+    assert urls == [
+        trailers.TrailerFile('720', 'The Snowman', 'Trailer', 'http://movietrailers.apple.com/movies/universal/thesnowman/thesnowman-trailer_h720p.mov'),
+        trailers.TrailerFile('720', 'The Snowman', 'Trailer 2', 'http://movietrailers.apple.com/movies/universal/thesnowman/thesnowman-trailer2_h720p.mov'),
+    ]
+
+
+def test_get_trailer_file_urls_not_in_run_report(replay_transport, monkeypatch):
+    monkeypatch.setattr(trailers, 'RUN_REPORT', trailers.RunReport())
+
+    trailers.get_trailer_file_urls("http://trailers.apple.com/trailers/universal/thesnowman/", "720", "trailers", [])
+
+    report = trailers.RUN_REPORT.to_dict()
+    assert report['movies'] == 0
+    assert report['phases'] == {}
+
+
+def test_get_trailer_file_urls_replay_compressed_page(replay_transport):
+    urls = trailers.get_trailer_file_urls("http://trailers.apple.com/trailers/independent/amelie", "720", "all", [])
+
+    assert [(u.title, u.type) for u in urls] == [(u'Amélie', 'Teaser'), (u'Amélie', 'Clip - The Garden')]
+
+
+def test_get_download_plan_entries():
+    trailer_urls = [
+        {'res': '1080', 'title': 'Film', 'type': 'Trailer 2', 'url': 'http://example.com/a.mov'},
+        {'res': '1080', 'title': 'Film', 'type': 'Clip', 'url': 'http://example.com/b.mov'},
+    ]
+    download_list = [u'Film.Trailer 2.1080p.mov', u'☃.Clip.480p.mov']
+
+    entries = trailers.get_download_plan_entries(trailer_urls, download_list, 'all')
+
+    assert [e['filename'] for e in entries] == [u'Film.Trailer 2.1080p.mov', u'Film.Clip.1080p.mov']
+    assert [e['action'] for e in entries] == ['skip', 'download']
+    assert entries[1]['url'] == 'http://example.com/b.mov'
+
+
+def test_write_and_load_download_plan():
+    tmp_file, tmp_file_path = tempfile.mkstemp()
+    os.close(tmp_file)
+    plan = {
+        'resolution': '720',
+        'video_types': 'all',
+        'files': [{'filename': u'★.Trailer.720p.mov', 'action': 'download', 'size': 10}],
+    }
+
+    trailers.write_download_plan(plan, tmp_file_path)
+
+    assert trailers.load_download_plan(tmp_file_path) == plan
+    os.remove(tmp_file_path)
+
+
+def test_load_download_plan_not_a_plan():
+    with pytest.raises(ValueError):
+        trailers.load_download_plan(DOWNLOAD_LIST_FIXTURE_PATH)
+
+
+def test_execute_download_plan_only_downloads_planned_files(monkeypatch):
+    downloaded = []
+
+    def fake_download_trailer_file(url, destdir, filename):
+        downloaded.append(filename)
+        return trailers.DownloadResult(trailers.DownloadResult.DOWNLOADED, filename)
+
+    monkeypatch.setattr(trailers, 'download_trailer_file', fake_download_trailer_file)
+    tmp_dir = tempfile.mkdtemp()
+    settings = {'download_dir': tmp_dir, 'list_file': os.path.join(tmp_dir, 'list.txt')}
+    plan = {'files': [
+        {'url': 'http://example.com/a.mov', 'type': 'Trailer', 'filename': 'A.Trailer.720p.mov', 'action': 'download'},
+        {'url': 'http://example.com/b.mov', 'type': 'Clip', 'filename': 'A.Clip.720p.mov', 'action': 'skip'},
+    ]}
+
+    trailers.execute_download_plan(plan, settings)
+
+    assert downloaded == ['A.Trailer.720p.mov']
+    assert trailers.get_downloaded_files(settings['list_file']) == ['A.Trailer.720p.mov']
+    shutil.rmtree(tmp_dir)
+
+
+def test_validate_settings_invalid_workers():
+    settings = copy.deepcopy(SOME_VALID_SETTINGS)
+    for workers in ['', '0', '-1', 'four']:
+        with pytest.raises(ValueError):
+            settings['workers'] = workers
+            trailers.validate_settings(settings)
+
+
+def test_validate_settings_invalid_max_workers():
+    settings = copy.deepcopy(SOME_VALID_SETTINGS)
+    for max_workers in ['', '0', 'sixteen']:
+        with pytest.raises(ValueError):
+            settings['max_workers'] = max_workers
+            trailers.validate_settings(settings)
+
+
+def test_get_max_workers():
+    assert trailers.get_max_workers({'workers': '4', 'max_workers': '16'}) == 16
+    assert trailers.get_max_workers({'workers': '8', 'max_workers': '2'}) == 8
+    assert trailers.get_max_workers({'workers': '3'}) == 3
+
+def test_record_downloaded_file_no_trailing_newline():
+    tmp_file, tmp_file_path = tempfile.mkstemp()
+    os.close(tmp_file)
+    with open(tmp_file_path, 'wb') as list_file:
+        list_file.write(u'☃.Clip.480p.mov'.encode('utf-8'))
+
+    trailers.record_downloaded_file(u'⚡.mov', tmp_file_path)
+    trailers.record_downloaded_file(u'Film.mov', tmp_file_path)
+
+    assert trailers.get_downloaded_files(tmp_file_path) == [u'☃.Clip.480p.mov', u'⚡.mov', u'Film.mov']
+    os.remove(tmp_file_path)
+
+
+def test_parse_shard():
+    assert trailers.parse_shard('1/3') == (1, 3)
+
+
+def test_parse_shard_invalid():
+    for shard in ['', '3', '3/3', '-1/3', '0/0', 'a/b', '1/2/3']:
+        with pytest.raises(ValueError):
+            trailers.parse_shard(shard)
+
+
+def test_url_in_shard_exactly_one_shard():
+    url = 'http://trailers.apple.com/trailers/lions_gate/thehungergames/'
+    shards = [i for i in range(4) if trailers.url_in_shard(url, '{}/4'.format(i))]
+    assert len(shards) == 1
+    assert trailers.get_url_shard(url + ' ', 4) == shards[0]
+
+
+def test_claim_file():
+    tmp_dir = tempfile.mkdtemp()
+
+    token = trailers.claim_file(tmp_dir, u'★.Trailer.720p.mov')
+    assert token
+    assert not trailers.claim_file(tmp_dir, u'★.Trailer.720p.mov')
+    trailers.release_file_claim(tmp_dir, u'★.Trailer.720p.mov', token)
+    assert trailers.claim_file(tmp_dir, u'★.Trailer.720p.mov')
+    shutil.rmtree(tmp_dir)
+
+
+def test_claim_file_stale_claim():
+    tmp_dir = tempfile.mkdtemp()
+    stale_token = trailers.claim_file(tmp_dir, u'Film.Trailer.720p.mov')
+    claim_path = trailers.get_claim_path(tmp_dir, u'Film.Trailer.720p.mov')
+    stale_time = os.path.getmtime(claim_path) - trailers.CLAIM_TIMEOUT_SECONDS - 1
+    os.utime(claim_path, (stale_time, stale_time))
+
+    token = trailers.claim_file(tmp_dir, u'Film.Trailer.720p.mov')
+    assert token and token != stale_token
+
+    # The process that held the stale claim must not release the new one
+    trailers.release_file_claim(tmp_dir, u'Film.Trailer.720p.mov', stale_token)
+    assert trailers.read_marker_file(claim_path) == token
+    assert os.listdir(tmp_dir) == [os.path.basename(claim_path)]
+    shutil.rmtree(tmp_dir)
+
+
+def test_record_downloaded_file_waits_for_lock(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    list_path = os.path.join(tmp_dir, 'download_list.txt')
+    lock_token = trailers.take_marker_file(list_path + '.lock', trailers.LIST_LOCK_TIMEOUT_SECONDS)
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        trailers.remove_marker_file(list_path + '.lock', lock_token)
+
+    monkeypatch.setattr(trailers.time, 'sleep', sleep)
+
+    trailers.record_downloaded_file(u'Film.Trailer.720p.mov', list_path)
+
+    assert len(sleeps) == 1
+    assert trailers.get_downloaded_files(list_path) == [u'Film.Trailer.720p.mov']
+    assert os.listdir(tmp_dir) == ['download_list.txt']
+    shutil.rmtree(tmp_dir)
+
+
+def test_post_download_hooks_run_in_order():
+    calls = []
+    hooks = trailers.PostDownloadHooks([
+        lambda trailer, path: calls.append(('remux', path)),
+        lambda trailer, path: calls.append(('notify', path)),
+    ], workers=1)
+
+    hooks.submit({'title': 'Film'}, '/tmp/Film.Trailer.720p.mov')
+    hooks.close()
+
+    assert calls == [('remux', '/tmp/Film.Trailer.720p.mov'), ('notify', '/tmp/Film.Trailer.720p.mov')]
+
+
+def test_post_download_hooks_failing_hook():
+    calls = []
+
+    def failing_hook(trailer, path):
+        raise OSError('disk full')
+
+    hooks = trailers.PostDownloadHooks([failing_hook, lambda trailer, path: calls.append(path)])
+    hooks.submit({'title': 'Film'}, 'a.mov')
+    hooks.submit({'title': 'Film'}, 'b.mov')
+    hooks.close()
+
+    assert sorted(calls) == ['a.mov', 'b.mov']
+
+
+def test_make_command_hook():
+    tmp_dir = tempfile.mkdtemp()
+    output_path = os.path.join(tmp_dir, 'output.txt')
+    hook = trailers.make_command_hook('cat > "{}"; echo "$TRAILER_FILE" >> "{}"'.format(output_path, output_path))
+    trailer = {'title': u'★ Film', 'type': 'Trailer', 'res': '720', 'url': 'http://example.com/a.mov'}
+
+    hook(trailer, '/tmp/Film.Trailer.720p.mov')
+
+    with open(output_path) as output_file:
+        output = output_file.read()
+    assert output.startswith('{')
+    assert '"type": "Trailer"' in output
+    assert output.endswith('}/tmp/Film.Trailer.720p.mov\n')
+    shutil.rmtree(tmp_dir)
+
+
+def test_download_trailer_file_new_file(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([FakeResponse(b'movie data')]))
+
+    result = trailers.download_trailer_file('http://example.com/a.mov', tmp_dir, u'★.Trailer.720p.mov')
+
+    assert result.ok
+    assert result.status == trailers.DownloadResult.DOWNLOADED
+    assert result.bytes_downloaded == 10
+    with open(os.path.join(tmp_dir, u'★.Trailer.720p.mov'), 'rb') as movie_file:
+        assert movie_file.read() == b'movie data'
+    assert os.listdir(tmp_dir) == [u'★.Trailer.720p.mov']
+    shutil.rmtree(tmp_dir)
+
+
+def test_download_trailer_file_resumes_part_file(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    with open(os.path.join(tmp_dir, 'Film.Trailer.720p.mov.part'), 'wb') as part_file:
+        part_file.write(b'movie ')
+    requests = []
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([FakeResponse(b'data', 206)], requests))
+
+    result = trailers.download_trailer_file('http://example.com/a.mov', tmp_dir, 'Film.Trailer.720p.mov')
+
+    assert result.ok
+    assert requests[0].get_header('Range') == 'bytes=6-'
+    with open(os.path.join(tmp_dir, 'Film.Trailer.720p.mov'), 'rb') as movie_file:
+        assert movie_file.read() == b'movie data'
+    shutil.rmtree(tmp_dir)
+
+
+def test_download_trailer_file_incomplete(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    response = FakeResponse(b'movie', headers={'Content-Length': '10'})
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([response]))
+
+    result = trailers.download_trailer_file('http://example.com/a.mov', tmp_dir, 'Film.Trailer.720p.mov')
+
+    assert not result.ok
+    assert os.listdir(tmp_dir) == ['Film.Trailer.720p.mov.part']
+    shutil.rmtree(tmp_dir)
+
+
+def test_download_trailer_file_part_file_complete(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    with open(os.path.join(tmp_dir, 'Film.Trailer.720p.mov.part'), 'wb') as part_file:
+        part_file.write(b'movie data')
+    error = HTTPError('http://example.com/a.mov', 416, 'Range Not Satisfiable', {}, None)
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([error]))
+
+    result = trailers.download_trailer_file('http://example.com/a.mov', tmp_dir, 'Film.Trailer.720p.mov')
+
+    assert result.ok
+    assert os.listdir(tmp_dir) == ['Film.Trailer.720p.mov']
+    shutil.rmtree(tmp_dir)
+
+
+def test_download_plan_entry_failed_download_not_recorded(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    error = HTTPError('http://example.com/a.mov', 404, 'Not Found', {}, None)
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([error]))
+    settings = {'download_dir': tmp_dir, 'list_file': os.path.join(tmp_dir, 'list.txt')}
+    entry = {'url': 'http://example.com/a.mov', 'type': 'Trailer', 'filename': 'A.Trailer.720p.mov'}
+
+    result = trailers.download_plan_entry(entry, settings)
+
+    assert not result.ok
+    assert trailers.get_downloaded_files(settings['list_file']) == []
+    shutil.rmtree(tmp_dir)
+
+
+def test_is_throttling_error():
+    assert trailers.is_throttling_error(HTTPError('http://example.com', 429, 'Too Many Requests', {}, None))
+    assert trailers.is_throttling_error(HTTPError('http://example.com', 503, 'Unavailable', {}, None))
+    assert not trailers.is_throttling_error(HTTPError('http://example.com', 404, 'Not Found', {}, None))
+    assert not trailers.is_throttling_error(ValueError('bad JSON'))
+
+
+def test_adaptive_concurrency_unlimited():
+    controller = trailers.AdaptiveConcurrency()
+    for _ in range(10):
+        controller.acquire()
+
+    assert controller.in_flight == 10
+    assert controller.get_metrics()['decisions'] == []
+
+
+def test_adaptive_concurrency_throttled_halves_limit():
+    controller = trailers.AdaptiveConcurrency()
+    controller.configure(8)
+    assert controller.limit == 8
+
+    with pytest.raises(HTTPError):
+        with controller.request():
+            raise HTTPError('http://example.com', 429, 'Too Many Requests', {}, None)
+
+    metrics = controller.get_metrics()
+    assert metrics['limit'] == 4
+    assert metrics['throttled_requests'] == 1
+    assert metrics['decisions'][-1]['reason'] == 'server throttled requests'
+
+
+def test_adaptive_concurrency_increases_limit():
+    controller = trailers.AdaptiveConcurrency()
+    controller.configure(4)
+    controller.set_limit(2, 'test')
+
+    for _ in range(2):
+        with controller.request() as stats:
+            stats.bytes = 1000
+
+    assert controller.limit == 3
+    assert controller.get_metrics()['bytes'] == 2000
+
+
+def test_adaptive_concurrency_configure_resets_run():
+    controller = trailers.AdaptiveConcurrency()
+    controller.configure(4)
+    with pytest.raises(HTTPError):
+        with controller.request():
+            raise HTTPError('http://example.com', 429, 'Too Many Requests', {}, None)
+
+    controller.configure(4)
+
+    metrics = controller.get_metrics()
+    assert metrics['limit'] == 4
+    assert metrics['requests'] == 0
+    assert [d['reason'] for d in metrics['decisions']] == ['initial limit']
+
+
+def test_adaptive_concurrency_never_exceeds_max():
+    controller = trailers.AdaptiveConcurrency()
+    controller.configure(2)
+
+    limits = []
+    for _ in range(20):
+        with controller.request() as stats:
+            stats.bytes = 1000
+        limits.append(controller.limit)
+
+    assert max(limits) == 2
+
+
+def test_adaptive_concurrency_raises_above_initial_limit():
+    controller = trailers.AdaptiveConcurrency()
+    controller.configure(2, 4)
+
+    limits = []
+    for _ in range(20):
+        with controller.request('download') as stats:
+            stats.bytes = 1000
+        limits.append(controller.limit)
+
+    assert limits[1] == 3
+    assert max(limits) <= 4
+
+
+def test_adaptive_concurrency_measures_kinds_separately():
+    controller = trailers.AdaptiveConcurrency()
+    controller.configure(2, 8)
+
+    with controller.request('download') as stats:
+        stats.bytes = 1000000
+    with controller.request('metadata') as stats:
+        stats.bytes = 100
+    assert controller.limit == 2
+
+    with controller.request('download') as stats:
+        stats.bytes = 1000000
+    assert controller.limit == 3
+    assert controller.get_metrics()['decisions'][-1]['reason'].startswith('download throughput increased')
+
+class RecordingRenderer(object):
+    def __init__(self):
+        self.renders = []
+        self.finished = []
+
+    def render(self, stats):
+        self.renders.append(stats)
+
+    def finish_file(self, stats):
+        self.finished.append(stats)
+
+
+def test_download_progress_totals():
+    renderer = RecordingRenderer()
+    progress = trailers.DownloadProgress(renderer, interval=0)
 
-# def test_get_trailer_file_urls_404():
-#     urls = trailers.get_trailer_file_urls("https://definingterms.com/random_url_XHNcTCAwihjCRoxV7igg9gwk", "480", ["all"], [])
-#     assert not urls
+    first = progress.start_file('a.mov', 100)
+    second = progress.start_file('b.mov', 50, 20)
+    first.update(10)
+    second.update(5)
+    first.finish()
 
+    assert renderer.renders[-1]['total_bytes'] == 15
+    assert [f['size'] for f in renderer.renders[-1]['files']] == [10, 25]
+    assert renderer.finished[0]['name'] == 'a.mov'
+    assert progress.finished_files == 1
+
+
+def test_download_progress_interval():
+    renderer = RecordingRenderer()
+    progress = trailers.DownloadProgress(renderer, interval=3600)
+
+    file_progress = progress.start_file('a.mov', 100)
+    for _ in range(10):
+        file_progress.update(10)
+
+    assert len(renderer.renders) == 1
+
+
+def test_download_progress_reset():
+    renderer = RecordingRenderer()
+    progress = trailers.DownloadProgress(renderer, interval=0)
+    progress.start_file('a.mov', 100).update(10)
+    progress.start_file('b.mov', 100)
+
+    progress.reset()
+    progress.start_file('c.mov', 100).update(5)
+
+    assert renderer.renders[-1]['total_bytes'] == 5
+    assert [f['name'] for f in renderer.renders[-1]['files']] == ['c.mov']
+    assert progress.finished_files == 0
+
+
+def test_progress_line_filter_clears_status_line():
+    stream = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    renderer = trailers.TtyProgressRenderer(stream)
+    handler = logging.StreamHandler(stream)
+    handler.addFilter(trailers.ProgressLineFilter(renderer))
+    logger = logging.getLogger('test_progress_line_filter')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    renderer.write_line('1.0 MB/s')
+    logger.warning('Downloading a.mov')
+
+    logger.removeHandler(handler)
+    assert stream.getvalue() == '\r1.0 MB/s\r        \rDownloading a.mov\n'
+    assert renderer.line_length == 0
+
+def test_download_trailer_file_reports_progress(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    renderer = RecordingRenderer()
+    monkeypatch.setattr(trailers, 'DOWNLOAD_PROGRESS', trailers.DownloadProgress(renderer, interval=0))
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([FakeResponse(b'movie data')]))
+
+    trailers.download_trailer_file('http://example.com/a.mov', tmp_dir, 'Film.Trailer.720p.mov')
+
+    assert renderer.finished[0]['size'] == 10
+    assert renderer.finished[0]['total_size'] == 10
+    shutil.rmtree(tmp_dir)
+
+
+def test_json_progress_renderer():
+    stream = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    renderer = trailers.JsonProgressRenderer(stream)
+
+    renderer.finish_file({'name': 'a.mov', 'size': 10})
+
+    assert stream.getvalue() == '{"event": "finished", "name": "a.mov", "size": 10}\n'
+
+
+def test_format_bytes():
+    assert trailers.format_bytes(512) == '512.0 B'
+    assert trailers.format_bytes(3 * 1024 * 1024) == '3.0 MB'
+
+
+def test_format_duration():
+    assert trailers.format_duration(3725) == '1:02:05'
+    assert trailers.format_duration(None) == '?'
+
+
+def make_page_data(title, clip_titles):
+    return {
+        'page': {'movie_title': title},
+        'clips': [{
+            'title': clip_title,
+            'versions': {'enus': {'sizes': {'hd720': {
+                'src': 'http://movietrailers.apple.com/movies/{}/{}_720p.mov'.format(title, len(clip_title)),
+            }}}},
+        } for clip_title in clip_titles],
+    }
+
+
+def fake_load_json_from_url(pages):
+    def load_json_from_url(url):
+        return pages.get(url, {})
+    return load_json_from_url
+
+
+def test_get_trailer_file_urls_returns_trailer_files(monkeypatch):
+    pages = {'http://trailers.apple.com/trailers/film/data/page.json': make_page_data('Film', ['Trailer', 'Clip'])}
+    monkeypatch.setattr(trailers, 'load_json_from_url', fake_load_json_from_url(pages))
+
+    urls = trailers.get_trailer_file_urls('http://trailers.apple.com/trailers/film/', '720', 'trailers', [])
+
+    assert urls == [trailers.TrailerFile('720', 'Film', 'Trailer', 'http://movietrailers.apple.com/movies/Film/7_h720p.mov')]
+    assert urls[0]['title'] == 'Film'
+    assert dict(urls[0]) == urls[0].to_dict()
+
+
+def test_trailer_file_has_no_dict():
+    trailer_file = trailers.TrailerFile('720', 'Film', 'Trailer', 'http://example.com/a.mov')
+
+    assert not hasattr(trailer_file, '__dict__')
+    with pytest.raises(KeyError):
+        trailer_file['filename']
+
+
+def test_trailer_file_dict_interface():
+    trailer_file = trailers.TrailerFile('720', 'Film', 'Trailer', 'http://example.com/a.mov')
+    trailer_dict = {'res': '720', 'title': 'Film', 'type': 'Trailer', 'url': 'http://example.com/a.mov'}
+
+    assert 'title' in trailer_file
+    assert 'filename' not in trailer_file
+    assert sorted(trailer_file) == sorted(trailer_dict)
+    assert trailer_file.get('title') == 'Film'
+    assert trailer_file.get('filename', 'default') == 'default'
+    assert sorted(trailer_file.items()) == sorted(trailer_dict.items())
+    assert dict(trailer_file) == trailer_dict
+    assert trailer_file == trailer_dict
+    assert trailer_file != dict(trailer_dict, res='1080')
+    assert trailers.json.loads(trailers.json.dumps(trailer_file.to_dict())) == trailer_dict
+
+
+def test_iter_feed_trailer_files(monkeypatch):
+    pages = {
+        'http://trailers.apple.com/trailers/one/data/page.json': make_page_data('One', ['Trailer']),
+        'http://trailers.apple.com/trailers/two/data/page.json': make_page_data('Two', ['Trailer', 'Teaser']),
+    }
+    monkeypatch.setattr(trailers, 'load_json_from_url', fake_load_json_from_url(pages))
+    page_urls = [
+        'http://trailers.apple.com/trailers/one/',
+        'http://trailers.apple.com/trailers/two/',
+        'http://trailers.apple.com/trailers/missing/',
+    ]
+
+    trailer_files = trailers.iter_feed_trailer_files(page_urls, '720', 'trailers', [], workers=2)
+
+    assert sorted((t.title, t.type) for t in trailer_files) == [('One', 'Trailer'), ('Two', 'Teaser'), ('Two', 'Trailer')]
+
+
+def test_iter_pool_results_bounded():
+    submitted = []
+
+    def items():
+        for item in range(100):
+            submitted.append(item)
+            yield item
+
+    results = trailers.iter_pool_results(lambda item: item * 2, items(), 4)
+
+    first = [next(results)]
+    assert len(submitted) == 4
+    first.extend(next(results) for _ in range(3))
+    assert len(submitted) == 7
+    results.close()
+    assert len(submitted) == 7
+    assert all(result % 2 == 0 and result < 14 for result in first)
+
+
+def test_iter_pool_results_all_and_errors():
+    assert sorted(trailers.iter_pool_results(lambda item: item * 2, range(10), 3)) == list(range(0, 20, 2))
+
+    def fail(item):
+        raise ValueError(item)
+
+    with pytest.raises(ValueError):
+        list(trailers.iter_pool_results(fail, range(3), 2))
+
+def record_archive(monkeypatch, archive_path, responses):
+    """Record the given responses, keyed by URL, into an HTTP archive."""
+    def urlopen(req):
+        response = responses[req.get_full_url()]
+        if isinstance(response, Exception):
+            raise response
+        return FakeResponse(response)
+
+    archive = trailers.HttpArchive(archive_path, 'record')
+    for url in responses:
+        try:
+            archive.open(url, urlopen).read()
+        except HTTPError:
+            pass
+    archive.close()
+
+
+def test_http_archive_record_and_replay(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    archive_path = os.path.join(tmp_dir, 'archive.zip')
+    record_archive(monkeypatch, archive_path, {
+        'http://example.com/data/page.json': b'{"page": {}}',
+        'http://example.com/missing.json': HTTPError('http://example.com/missing.json', 404, 'Not Found', {}, None),
+    })
+
+    archive = trailers.HttpArchive(archive_path, 'replay')
+    response = archive.open('http://example.com/data/page.json', None)
+    assert response.read() == b'{"page": {}}'
+    assert response.info().get('content-length') == '12'
+    with pytest.raises(HTTPError) as error:
+        archive.open('http://example.com/missing.json', None)
+    assert error.value.code == 404
+    with pytest.raises(trailers.URLError):
+        archive.open('http://example.com/not_recorded.json', None)
+    archive.close()
+    shutil.rmtree(tmp_dir)
+
+
+def test_http_archive_record_same_request_twice(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    archive_path = os.path.join(tmp_dir, 'archive.zip')
+    bodies = [b'{"first": 1}', b'{"again": 2}', b'{"other": 3}']
+
+    def urlopen(req):
+        return FakeResponse(bodies.pop(0))
+
+    archive = trailers.HttpArchive(archive_path, 'record')
+    for url in ['http://example.com/a.json', 'http://example.com/a.json', 'http://example.com/b.json']:
+        archive.open(url, urlopen).read()
+    archive.close()
+
+    archive = trailers.HttpArchive(archive_path, 'replay')
+    assert archive.open('http://example.com/a.json', None).read() == b'{"again": 2}'
+    assert archive.open('http://example.com/b.json', None).read() == b'{"other": 3}'
+    assert len(archive.zip_file.namelist()) == 3
+    archive.close()
+    shutil.rmtree(tmp_dir)
+
+
+def test_http_archive_record_keeps_full_download(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    archive_path = os.path.join(tmp_dir, 'archive.zip')
+    body = b'x' * (trailers.RECORD_MAX_MEDIA_SIZE * 2 + 10)
+    transport = trailers.HttpTransport()
+    transport.archive = trailers.HttpArchive(archive_path, 'record')
+    monkeypatch.setattr(trailers, 'HTTP_TRANSPORT', transport)
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([FakeResponse(body)]))
+
+    result = trailers.download_trailer_file('http://example.com/a.mov', tmp_dir, 'Film.Trailer.720p.mov')
+    transport.archive.close()
+
+    assert result.ok
+    assert result.bytes_downloaded == len(body)
+    assert os.path.getsize(os.path.join(tmp_dir, 'Film.Trailer.720p.mov')) == len(body)
+    response = trailers.HttpArchive(archive_path, 'replay').open('http://example.com/a.mov', None)
+    assert response.read() == body[:trailers.RECORD_MAX_MEDIA_SIZE]
+    assert response.info().get('Content-Length') == str(trailers.RECORD_MAX_MEDIA_SIZE)
+    shutil.rmtree(tmp_dir)
+
+
+def test_http_archive_replay_range(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    archive_path = os.path.join(tmp_dir, 'archive.zip')
+    record_archive(monkeypatch, archive_path, {'http://example.com/a.mov': b'movie data'})
+
+    archive = trailers.HttpArchive(archive_path, 'replay')
+    response = archive.open(trailers.Request('http://example.com/a.mov', None, {'Range': 'bytes=6-'}), None)
+    assert response.getcode() == 206
+    assert response.read() == b'data'
+    with pytest.raises(HTTPError) as error:
+        archive.open(trailers.Request('http://example.com/a.mov', None, {'Range': 'bytes=10-'}), None)
+    assert error.value.code == 416
+    archive.close()
+    shutil.rmtree(tmp_dir)
+
+
+def test_main_replay(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    archive_path = os.path.join(tmp_dir, 'archive.zip')
+    list_path = os.path.join(tmp_dir, 'download_list.txt')
+    page_data = make_page_data('Film', ['Trailer', 'Clip'])
+    record_archive(monkeypatch, archive_path, {
+        'http://trailers.apple.com/trailers/home/feeds/just_added.json': b'[{"location": "/trailers/studio/film/"}]',
+        'http://trailers.apple.com/trailers/studio/film/data/page.json': trailers.json.dumps(page_data).encode('utf-8'),
+        'http://movietrailers.apple.com/movies/Film/7_h720p.mov': b'movie data',
+    })
+    monkeypatch.setattr(sys, 'argv', [
+        'download_trailers.py', '--replay', archive_path, '-d', tmp_dir, '-l', list_path,
+        '-c', os.path.join(tmp_dir, 'settings.cfg'), '-o', 'error', '--progress', 'none',
+    ])
+    monkeypatch.setattr(os.path, 'expanduser', lambda path: path.replace('~', tmp_dir))
+    monkeypatch.setattr(trailers, 'HTTP_TRANSPORT', trailers.HttpTransport())
+    monkeypatch.setattr(trailers, 'HTTP_CONCURRENCY', trailers.AdaptiveConcurrency())
+
+    trailers.main()
+
+    assert trailers.get_downloaded_files(list_path) == [u'Film.Trailer.720p.mov']
+    with open(os.path.join(tmp_dir, 'Film.Trailer.720p.mov'), 'rb') as movie_file:
+        assert movie_file.read() == b'movie data'
+    shutil.rmtree(tmp_dir)
+
+
+def test_main_replay_fixture(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    list_path = os.path.join(tmp_dir, 'download_list.txt')
+    monkeypatch.setattr(sys, 'argv', [
+        'download_trailers.py', '--replay', HTTP_ARCHIVE_FIXTURE_PATH, '-d', tmp_dir, '-l', list_path,
+        '-c', os.path.join(tmp_dir, 'settings.cfg'), '-v', 'trailers', '-o', 'error', '--progress', 'none',
+    ])
+    monkeypatch.setattr(os.path, 'expanduser', lambda path: path.replace('~', tmp_dir))
+    monkeypatch.setattr(trailers, 'HTTP_TRANSPORT', trailers.HttpTransport())
+    monkeypatch.setattr(trailers, 'HTTP_CONCURRENCY', trailers.AdaptiveConcurrency())
+
+    trailers.main()
+
+    expected = [u'Amélie.Teaser.720p.mov', u'The Snowman.Trailer 2.720p.mov', u'The Snowman.Trailer.720p.mov']
+    assert sorted(trailers.get_downloaded_files(list_path)) == expected
+    assert sorted(f for f in os.listdir(tmp_dir) if f.endswith('.mov')) == expected
+    with open(os.path.join(tmp_dir, u'The Snowman.Trailer.720p.mov'), 'rb') as movie_file:
+        assert movie_file.read().startswith(b'The Snowman Trailer 720p ')
+    shutil.rmtree(tmp_dir)
+
+
+def test_main_plan_not_in_run_history(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    list_path = os.path.join(tmp_dir, 'download_list.txt')
+    plan_path = os.path.join(tmp_dir, 'plan.json')
+    monkeypatch.setattr(sys, 'argv', [
+        'download_trailers.py', '--replay', HTTP_ARCHIVE_FIXTURE_PATH, '-d', tmp_dir, '-l', list_path,
+        '-c', os.path.join(tmp_dir, 'settings.cfg'), '-v', 'trailers', '-o', 'error', '--progress', 'none',
+        '--plan', plan_path,
+    ])
+    monkeypatch.setattr(os.path, 'expanduser', lambda path: path.replace('~', tmp_dir))
+    monkeypatch.setattr(trailers, 'HTTP_TRANSPORT', trailers.HttpTransport())
+    monkeypatch.setattr(trailers, 'HTTP_CONCURRENCY', trailers.AdaptiveConcurrency())
+    monkeypatch.setattr(trailers, 'get_remote_file_size', lambda url: None)
+    monkeypatch.setattr(trailers, 'RUN_REPORT', trailers.RunReport())
+
+    trailers.main()
+
+    assert len(trailers.load_download_plan(plan_path)['files']) == 3
+    assert trailers.RUN_REPORT.to_dict()['movies'] == 2
+    assert not os.path.exists(list_path + '.runs')
+    shutil.rmtree(tmp_dir)
+
+
+def test_run_journal_resume():
+    tmp_dir = tempfile.mkdtemp()
+    journal_path = os.path.join(tmp_dir, 'download_list.txt.journal')
+    trailer_file = trailers.TrailerFile('720', u'★ Film', 'Trailer', 'http://example.com/a.mov')
+
+    journal = trailers.RunJournal(journal_path, '720', 'all')
+    assert not journal.is_resuming()
+    journal.start(['http://example.com/one/', 'http://example.com/two/'])
+    journal.record_page('http://example.com/one/', [trailer_file])
+    journal.record_file_start(tmp_dir, u'★ Film.Trailer.720p.mov')
+    with open(journal_path, 'ab') as journal_file:
+        journal_file.write(b'{"event": "page", "url": "http://exa')
+
+    resumed = trailers.RunJournal(journal_path, '720', 'all')
+    assert resumed.is_resuming()
+    assert resumed.page_urls == ['http://example.com/one/', 'http://example.com/two/']
+    assert resumed.resolved_pages == {'http://example.com/one/': [trailer_file]}
+    assert resumed.file_offsets == {u'★ Film.Trailer.720p.mov': 0}
+
+    resumed.finish()
+    assert not os.path.exists(journal_path)
+    shutil.rmtree(tmp_dir)
+
+
+def test_run_journal_other_settings_ignored():
+    tmp_dir = tempfile.mkdtemp()
+    journal_path = os.path.join(tmp_dir, 'download_list.txt.journal')
+    trailers.RunJournal(journal_path, '720', 'all').start(['http://example.com/one/'])
+
+    assert not trailers.RunJournal(journal_path, '1080', 'all').is_resuming()
+    shutil.rmtree(tmp_dir)
+
+
+def test_run_journal_per_shard():
+    tmp_dir = tempfile.mkdtemp()
+    settings = {'list_file': os.path.join(tmp_dir, 'download_list.txt')}
+    shard_paths = [trailers.get_journal_path(dict(settings, shard=shard)) for shard in ('0/2', '1/2')]
+    trailers.RunJournal(shard_paths[0], '720', 'all', '0/2').start(['http://example.com/one/'])
+    trailers.RunJournal(shard_paths[1], '720', 'all', '1/2').start(['http://example.com/two/'])
+
+    assert len(set(shard_paths + [trailers.get_journal_path(settings)])) == 3
+    assert trailers.RunJournal(shard_paths[0], '720', 'all', '0/2').page_urls == ['http://example.com/one/']
+    assert not trailers.RunJournal(shard_paths[0], '720', 'all', '1/2').is_resuming()
+    assert not trailers.RunJournal(shard_paths[0], '720', 'all', '0/2', 'http://mirror:8080').is_resuming()
+    shutil.rmtree(tmp_dir)
+
+
+def test_run_journal_discards_changed_part_file():
+    tmp_dir = tempfile.mkdtemp()
+    journal_path = os.path.join(tmp_dir, 'download_list.txt.journal')
+    part_path = os.path.join(tmp_dir, u'Film.Trailer.720p.mov.part')
+    with open(part_path, 'wb') as part_file:
+        part_file.write(b'0123456789')
+    journal = trailers.RunJournal(journal_path, '720', 'all')
+    journal.start(['http://example.com/one/'])
+    journal.record_file_start(tmp_dir, u'Film.Trailer.720p.mov')
+    with open(part_path, 'wb') as part_file:
+        part_file.write(b'01234')
+
+    trailers.RunJournal(journal_path, '720', 'all').record_file_start(tmp_dir, u'Film.Trailer.720p.mov')
+
+    assert not os.path.exists(part_path)
+    shutil.rmtree(tmp_dir)
+
+
+def test_download_feed_uses_resolved_pages_from_journal(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    settings = {
+        'download_dir': tmp_dir,
+        'list_file': os.path.join(tmp_dir, 'list.txt'),
+        'resolution': '720',
+        'video_types': 'all',
+        'download_all_urls': [],
+    }
+    journal = trailers.RunJournal(trailers.get_journal_path(settings), '720', 'all')
+    journal.start(['http://example.com/one/'])
+    journal.record_page('http://example.com/one/', [
+        trailers.TrailerFile('720', 'Film', 'Trailer', 'http://example.com/a.mov')])
+    monkeypatch.setattr(trailers, 'load_json_from_url', fake_load_json_from_url({}))
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([FakeResponse(b'movie data')]))
+    monkeypatch.setattr(trailers, 'RUN_REPORT', trailers.RunReport())
+
+    trailers.download_feed(['http://example.com/one/'], settings, journal=trailers.RunJournal(
+        trailers.get_journal_path(settings), '720', 'all'))
+
+    assert trailers.get_downloaded_files(settings['list_file']) == ['Film.Trailer.720p.mov']
+    assert trailers.RUN_REPORT.to_dict()['movies'] == 1
+    shutil.rmtree(tmp_dir)
+
+
+def test_download_feed_downloads_concurrently(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    settings = {
+        'download_dir': tmp_dir,
+        'list_file': os.path.join(tmp_dir, 'list.txt'),
+        'resolution': '720',
+        'video_types': 'all',
+        'download_all_urls': [],
+        'workers': '2',
+    }
+    pages = {'http://example.com/film/data/page.json': make_page_data('Film', ['Trailer', 'Clip'])}
+    monkeypatch.setattr(trailers, 'load_json_from_url', fake_load_json_from_url(pages))
+    both_started = threading.Barrier(2, timeout=5) if hasattr(threading, 'Barrier') else None
+    downloaded = []
+
+    def download_plan_entry(entry, settings, hooks=None):
+        if both_started:
+            # Fails with BrokenBarrierError if the downloads run one at a time
+            both_started.wait()
+        downloaded.append(entry['filename'])
+
+    monkeypatch.setattr(trailers, 'download_plan_entry', download_plan_entry)
+
+    trailers.download_feed(['http://example.com/film/', 'http://example.com/film/'], settings)
+
+    assert sorted(downloaded) == ['Film.Clip.720p.mov', 'Film.Trailer.720p.mov']
+    shutil.rmtree(tmp_dir)
+
+
+def test_dns_cache(monkeypatch):
+    lookups = []
+
+    def getaddrinfo(host, port, *args):
+        lookups.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    cache = trailers.DnsCache(ttl=300)
+
+    assert cache.resolve('trailers.apple.com', 80) == cache.resolve('trailers.apple.com', 80)
+    assert lookups == ['trailers.apple.com']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.ttl = -1
+    cache.resolve('movietrailers.apple.com', 80)
+    cache.resolve('movietrailers.apple.com', 80)
+    assert lookups == ['trailers.apple.com', 'movietrailers.apple.com', 'movietrailers.apple.com']
+
+
+def test_interleave_address_families():
+    addresses = [
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 80, 0, 0)),
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::2', 80, 0, 0)),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 80)),
+    ]
+
+    interleaved = trailers.interleave_address_families(addresses)
+
+    assert [a[4][0] for a in interleaved] == ['::1', '127.0.0.1', '::2']
+
+
+def test_connect_happy_eyeballs_skips_failed_address():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(('127.0.0.1', 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+    addresses = [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', closed_port)),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', server.getsockname()),
+    ]
+
+    sock = trailers.connect_happy_eyeballs(addresses, timeout=5)
+
+    assert sock.getpeername() == server.getsockname()
+    sock.close()
+    server.close()
+
+
+def test_connect_happy_eyeballs_all_failed():
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(('127.0.0.1', 0))
+    address = (socket.AF_INET, socket.SOCK_STREAM, 6, '', closed.getsockname())
+    closed.close()
+
+    with pytest.raises(socket.error):
+        trailers.connect_happy_eyeballs([address], timeout=5)
+
+
+def write_config_file(path, values, mtime):
+    with open(path, 'w') as config_file:
+        config_file.write('[DEFAULT]\n')
+        for name, value in values.items():
+            config_file.write('{} = {}\n'.format(name, value))
+    os.utime(path, (mtime, mtime))
+
+
+def make_live_settings(tmp_dir, args):
+    config_path = os.path.join(tmp_dir, 'settings.cfg')
+    write_config_file(config_path, {'resolution': '720', 'video_types': 'all'}, 1000)
+    settings = copy.deepcopy(SOME_VALID_SETTINGS)
+    settings.update(trailers.get_config_values(config_path, SOME_CONFIG_DEFAULTS))
+    settings.update(args)
+    settings['download_dir'] = tmp_dir
+    settings['config_path'] = config_path
+    return trailers.LiveSettings(settings, SOME_CONFIG_DEFAULTS, args)
+
+
+def test_live_settings_reload_unchanged():
+    tmp_dir = tempfile.mkdtemp()
+    settings = make_live_settings(tmp_dir, {})
+
+    assert settings.reload() == []
+    assert settings['resolution'] == '720'
+    shutil.rmtree(tmp_dir)
+
+
+def test_live_settings_reload_changed():
+    tmp_dir = tempfile.mkdtemp()
+    settings = make_live_settings(tmp_dir, {'video_types': 'trailers'})
+    write_config_file(settings['config_path'], {
+        'resolution': '1080',
+        'video_types': 'single_trailer',
+        'download_all_urls': 'https://trailers.apple.com/trailers/one/',
+    }, 2000)
+
+    changed = settings.reload()
+
+    assert sorted(changed) == ['download_all_urls', 'resolution']
+    assert settings['resolution'] == '1080'
+    assert settings['video_types'] == 'trailers'
+    assert settings['download_all_urls'] == frozenset(['/trailers/one'])
+    shutil.rmtree(tmp_dir)
+
+
+def test_live_settings_reload_invalid():
+    tmp_dir = tempfile.mkdtemp()
+    settings = make_live_settings(tmp_dir, {})
+    write_config_file(settings['config_path'], {'resolution': '4k'}, 2000)
+
+    with pytest.raises(ValueError):
+        settings.reload()
+    assert settings['resolution'] == '720'
+    shutil.rmtree(tmp_dir)
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def test_read_decompressed_gzip():
+    body = b'{"clips": []}' * 100
+    compressed = gzip_compress(body)
+    response = FakeResponse(compressed, headers={'Content-Encoding': 'gzip'})
+
+    assert trailers.read_decompressed(response, chunk_size=16) == (body, len(compressed))
+
+
+def test_read_decompressed_identity():
+    assert trailers.read_decompressed(FakeResponse(b'[]', headers={})) == (b'[]', 2)
+
+
+def test_read_decompressed_unknown_encoding():
+    with pytest.raises(ValueError):
+        trailers.read_decompressed(FakeResponse(b'[]', headers={'Content-Encoding': 'zstd'}))
+
+
+def test_load_json_from_url_compressed(monkeypatch):
+    requests = []
+    compressed = gzip_compress(b'{"page": {"movie_title": "Film"}}')
+    response = FakeResponse(compressed, headers={'Content-Encoding': 'gzip'})
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([response], requests))
+    monkeypatch.setattr(trailers, 'HTTP_TRANSPORT', trailers.HttpTransport())
+
+    data = trailers.load_json_from_url('http://example.com/data/page.json')
+
+    assert data == {'page': {'movie_title': 'Film'}}
+    assert 'gzip' in requests[0].get_header('Accept-encoding')
+    assert trailers.HTTP_TRANSPORT.get_metrics()['metadata_compressed_bytes'] == len(compressed)
+
+
+def test_download_trailer_file_not_compressed(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    requests = []
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([FakeResponse(b'movie data')], requests))
+
+    trailers.download_trailer_file('http://example.com/a.mov', tmp_dir, 'Film.Trailer.720p.mov')
+
+    assert requests[0].get_header('Accept-encoding') == 'identity'
+    shutil.rmtree(tmp_dir)
+
+
+def test_run_report():
+    report = trailers.RunReport()
+    report.count('movies', 2)
+    report.count('skipped')
+    report.add_phase_time('discovery', 0.5)
+    report.record_download('http://movietrailers.apple.com/a.mov',
+                           trailers.DownloadResult(trailers.DownloadResult.DOWNLOADED, 'a.mov', 1000), 2.0)
+    report.record_download('http://movietrailers.apple.com/b.mov',
+                           trailers.DownloadResult(trailers.DownloadResult.FAILED, 'b.mov'), 1.0)
+
+    report_dict = report.to_dict()
+
+    assert report_dict['movies'] == 2
+    assert report_dict['skipped'] == 1
+    assert (report_dict['downloaded'], report_dict['failed']) == (1, 1)
+    assert report_dict['bytes'] == 1000
+    assert report_dict['phases'] == {'discovery': 0.5, 'download': 3.0}
+    assert report_dict['hosts'] == {'movietrailers.apple.com': [1000, 3.0]}
+
+
+def test_run_history_stats():
+    tmp_dir = tempfile.mkdtemp()
+    history_path = os.path.join(tmp_dir, 'download_list.txt.runs')
+    for index in range(3):
+        trailers.append_run_report({
+            'movies': 10, 'planned': 2, 'skipped': 8, 'downloaded': 2, 'failed': 0,
+            'bytes': 4000 * (index + 1), 'wall_time': 10.0, 'phases': {'download': 2.0},
+            'hosts': {'fast.example.com': [3000, 1.0], 'slow.example.com': [1000 * (index + 1), 1.0]},
+        }, history_path)
+
+    reports = trailers.load_run_reports(history_path, 2)
+    stats = trailers.get_run_stats(reports)
+
+    assert stats['runs'] == 2
+    assert stats['movies'] == 20
+    assert stats['bytes'] == 8000 + 12000
+    assert stats['average_throughput'] == 5000
+    assert stats['slowest_hosts'][0] == (2500, 'slow.example.com')
+
+    output = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    trailers.write_run_stats(stats, output)
+    assert 'slow.example.com' in output.getvalue()
+    shutil.rmtree(tmp_dir)
+
+
+def test_validate_settings_invalid_runs():
+    settings = copy.deepcopy(SOME_VALID_SETTINGS)
+    for runs in ['', '0', '-1', 'ten']:
+        with pytest.raises(ValueError):
+            settings['runs'] = runs
+            trailers.validate_settings(settings)
+
+
+def test_load_run_reports_missing_file():
+    assert trailers.load_run_reports('/not/a/real/path/list.txt.runs', 10) == []
+
+
+def test_filename_index_collision():
+    index = trailers.FilenameIndex()
+    first = index.reserve(u'Top Gun Maverick.Trailer.720p.mov', 'http://example.com/topgun/a.mov')
+    second = index.reserve(u'Top Gun Maverick.Trailer.720p.mov', 'http://example.com/topgun2/a.mov')
+
+    assert first == u'Top Gun Maverick.Trailer.720p.mov'
+    assert second.startswith(u'Top Gun Maverick.Trailer.720p.')
+    assert second.endswith(u'.mov')
+    assert second != first
+    assert index.reserve(u'Top Gun Maverick.Trailer.720p.mov', 'http://example.com/topgun2/a.mov') == second
+
+
+def test_filename_index_case_insensitive():
+    tmp_dir = tempfile.mkdtemp()
+    open(os.path.join(tmp_dir, u'Film.Trailer.720p.mov'), 'w').close()
+    open(os.path.join(tmp_dir, u'Other.Trailer.720p.mov.part'), 'w').close()
+    index = trailers.FilenameIndex()
+
+    index.build(tmp_dir, case_insensitive=True)
+
+    assert index.reserve(u'Film.Trailer.720p.mov', 'http://example.com/a.mov') == u'Film.Trailer.720p.mov'
+    assert index.reserve(u'FILM.Trailer.720p.mov', 'http://example.com/b.mov') != u'FILM.Trailer.720p.mov'
+    assert index.reserve(u'other.trailer.720p.mov', 'http://example.com/c.mov') != u'other.trailer.720p.mov'
+    shutil.rmtree(tmp_dir)
+
+
+def test_get_download_plan_entries_collision():
+    trailer_urls = [
+        {'res': '720', 'title': 'Film?', 'type': 'Trailer', 'url': 'http://example.com/a.mov'},
+        {'res': '720', 'title': 'Film!', 'type': 'Trailer', 'url': 'http://example.com/b.mov'},
+    ]
+
+    entries = trailers.get_download_plan_entries(trailer_urls, [], 'all')
+
+    assert entries[0]['filename'] == 'Film.Trailer.720p.mov'
+    assert entries[1]['filename'] != 'Film.Trailer.720p.mov'
+    assert [e['action'] for e in entries] == ['download', 'download']
+
+
+def test_parse_byte_range():
+    assert trailers.parse_byte_range(None, 10) is None
+    assert trailers.parse_byte_range('bytes=2-5', 10) == (2, 5)
+    assert trailers.parse_byte_range('bytes=2-', 10) == (2, 9)
+    assert trailers.parse_byte_range('bytes=-3', 10) == (7, 9)
+    assert trailers.parse_byte_range('bytes=5-100', 10) == (5, 9)
+    with pytest.raises(ValueError):
+        trailers.parse_byte_range('bytes=10-', 10)
+
+
+def test_get_file_url():
+    url = 'http://movietrailers.apple.com/movies/Film/7_h720p.mov'
+
+    assert trailers.get_file_url(url, {}) == url
+    assert trailers.get_file_url(url, {'base_url': 'http://mirror:8080/'}) == \
+        'http://mirror:8080/movies/Film/7_h720p.mov'
+    assert trailers.get_mirror_upstream_url('/movies/Film/7_h720p.mov') == url
+
+
+def test_get_page_urls_base_url(monkeypatch):
+    requested_urls = []
+
+    def load_json_from_url(url):
+        requested_urls.append(url)
+        return [{'location': '/trailers/studio/film/'}]
+
+    monkeypatch.setattr(trailers, 'load_json_from_url', load_json_from_url)
+
+    page_urls = trailers.get_page_urls({'base_url': 'http://mirror:8080'})
+
+    assert requested_urls == ['http://mirror:8080/trailers/home/feeds/just_added.json']
+    assert page_urls == ['http://mirror:8080/trailers/studio/film/']
+
+
+def test_get_download_plan_sizes_from_base_url(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    size_urls = []
+
+    def get_remote_file_size(url):
+        size_urls.append(url)
+        return 10
+
+    monkeypatch.setattr(trailers, 'get_trailer_file_urls', lambda *args: [
+        {'res': '720', 'title': 'Film', 'type': 'Trailer',
+         'url': 'http://movietrailers.apple.com/movies/Film/7_h720p.mov'},
+    ])
+    monkeypatch.setattr(trailers, 'get_remote_file_size', get_remote_file_size)
+    settings = {
+        'list_file': os.path.join(tmp_dir, 'download_list.txt'),
+        'resolution': '720',
+        'video_types': 'all',
+        'download_all_urls': '',
+        'base_url': 'http://mirror:8080',
+    }
+
+    plan = trailers.get_download_plan(['http://mirror:8080/trailers/studio/film/'], settings)
+
+    assert size_urls == ['http://mirror:8080/movies/Film/7_h720p.mov']
+    assert plan['files'][0]['url'] == 'http://movietrailers.apple.com/movies/Film/7_h720p.mov'
+    assert plan['files'][0]['size'] == 10
+    shutil.rmtree(tmp_dir)
+
+def test_mirror_server(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    upstream_requests = []
+    monkeypatch.setattr(trailers, 'HTTP_TRANSPORT', trailers.HttpTransport())
+    monkeypatch.setattr(trailers, 'urlopen', fake_urlopen([
+        FakeResponse(b'[]'),
+        FakeResponse(b'movie data'),
+    ], upstream_requests))
+    server = trailers.MirrorServer(('127.0.0.1', 0), trailers.TrailerMirror(tmp_dir))
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+
+    def get(path, headers=None):
+        connection = HTTPConnection('127.0.0.1', server.server_address[1])
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        result = (response.status, response.read())
+        connection.close()
+        return result
+
+    try:
+        assert get('/trailers/home/feeds/just_added.json') == (200, b'[]')
+        assert get('/trailers/home/feeds/just_added.json') == (200, b'[]')
+        assert get('/movies/Film/7_h720p.mov') == (200, b'movie data')
+        assert get('/movies/Film/7_h720p.mov', {'Range': 'bytes=6-'}) == (206, b'data')
+        assert get('/movies/Film/7_h720p.mov', {'Range': 'bytes=20-'})[0] == 416
+        assert get('/movies/../../etc/passwd')[0] == 400
+        assert get('/')[0] == 404
+        assert get('/movies/Film')[0] == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+    assert [req.get_full_url() for req in upstream_requests] == [
+        'http://trailers.apple.com/trailers/home/feeds/just_added.json',
+        'http://movietrailers.apple.com/movies/Film/7_h720p.mov',
+    ]
+    shutil.rmtree(tmp_dir)
+
+
+def test_trace_recorder_disabled():
+    recorder = trailers.TraceRecorder()
+
+    with recorder.span('load_json_from_url', 'fetch'):
+        pass
+
+    assert recorder.events == []
+
+
+def test_trace_recorder_span_stats():
+    recorder = trailers.TraceRecorder()
+    recorder.enable()
+
+    with recorder.span('download_trailer_file', 'download', {'arg': 'http://example.com/a.mov'}):
+        with recorder.span('load_json_from_url', 'fetch'):
+            pass
+    with recorder.span('load_json_from_url', 'fetch'):
+        pass
+
+    assert [e['name'] for e in recorder.events] == ['load_json_from_url', 'download_trailer_file', 'load_json_from_url']
+    assert recorder.events[1]['args'] == {'arg': 'http://example.com/a.mov'}
+    stats = dict(((name, category), calls) for name, category, calls, _, _ in recorder.get_span_stats())
+    assert stats == {('load_json_from_url', 'fetch'): 2, ('download_trailer_file', 'download'): 1}
+
+
+def test_run_profiled(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    profile_path = os.path.join(tmp_dir, 'run.prof')
+    monkeypatch.setattr(trailers, 'TRACE', trailers.TraceRecorder())
+
+    @trailers.traced('fetch')
+    def fetch(url):
+        return url.upper()
+
+    def run(settings):
+        pool = trailers.ThreadPool(2)
+        result = pool.map(fetch, settings['urls'])
+        pool.close()
+        pool.join()
+        return result
+
+    trailers.run_profiled(run, {'urls': ['a', 'b', 'c']}, profile_path)
+
+    with open(profile_path + '.trace.json') as trace_file:
+        events = trailers.json.load(trace_file)['traceEvents']
+    spans = [e for e in events if e['ph'] == 'X']
+    assert sorted(e['args']['arg'] for e in spans) == ['a', 'b', 'c']
+    assert all(e['name'] == 'fetch' and e['cat'] == 'fetch' for e in spans)
+    assert [e['args']['name'] for e in events if e['ph'] == 'M']
+    with open(profile_path + '.txt') as report_file:
+        assert 'fetch' in report_file.read()
+    assert os.path.getsize(profile_path) > 0
+    shutil.rmtree(tmp_dir)
+
+
+def make_indexed_history(filenames, unindexed=()):
+    """Write a download list with the given files, index it, append the
+    unindexed files and return the path of the list."""
+    tmp_dir = tempfile.mkdtemp()
+    list_path = os.path.join(tmp_dir, 'download_list.txt')
+    trailers.write_downloaded_files(filenames, list_path)
+    trailers.build_history_index(list_path)
+    for filename in unindexed:
+        trailers.record_downloaded_file(filename, list_path)
+    return list_path
+
+
+def test_download_history_index_lookups():
+    list_path = make_indexed_history([u'Film.Trailer 2.1080p.mov', u'☃.Clip.480p.mov', u'Other.Teaser.720p.mov'])
+    history = trailers.load_download_history(list_path)
+
+    assert history.index is not None
+    assert history.recent == set()
+    assert u'☃.Clip.480p.mov' in history
+    assert u'Film.Trailer 2.1080p.mov' in history
+    assert u'film.trailer 2.1080p.mov' not in history
+    assert u'Missing.Trailer.720p.mov' not in history
+    assert history.has_prefix(u'film.trailer')
+    assert not history.has_prefix(u'other.trailer')
+    history.close()
+    shutil.rmtree(os.path.dirname(list_path))
+
+
+def test_download_history_reads_unindexed_files():
+    list_path = make_indexed_history([u'Film.Trailer.1080p.mov'], [u'New Film.Trailer.720p.mov'])
+    history = trailers.load_download_history(list_path)
+
+    assert history.recent == set([u'New Film.Trailer.720p.mov'])
+    assert u'New Film.Trailer.720p.mov' in history
+    assert u'Film.Trailer.1080p.mov' in history
+    assert trailers.file_already_downloaded(history, u'New Film', u'Trailer', u'720', u'single_trailer')
+    history.close()
+    shutil.rmtree(os.path.dirname(list_path))
+
+
+def test_download_history_ignores_outdated_index():
+    list_path = make_indexed_history([u'Film.Trailer.1080p.mov', u'Old.Trailer.720p.mov'])
+    # A manual edit that makes the list longer than the indexed part
+    trailers.write_downloaded_files([u'Film.Trailer.1080p.mov', u'A Much Longer Title.Trailer.720p.mov'], list_path)
+    history = trailers.DownloadHistory(list_path)
+    history.load()
+
+    assert history.index is None
+    assert history.needs_rebuild()
+    assert history.recent == set([u'Film.Trailer.1080p.mov', u'A Much Longer Title.Trailer.720p.mov'])
+    assert u'Old.Trailer.720p.mov' not in history
+
+    rebuilt = trailers.load_download_history(list_path)
+    assert rebuilt.index is not None
+    assert rebuilt.count == 2
+    assert u'Old.Trailer.720p.mov' not in rebuilt
+    assert u'A Much Longer Title.Trailer.720p.mov' in rebuilt
+    rebuilt.close()
+    shutil.rmtree(os.path.dirname(list_path))
+
+
+def test_build_history_index_replaces_index():
+    list_path = make_indexed_history([u'Film.Trailer.1080p.mov'], [u'New.Clip.720p.mov'])
+
+    assert trailers.build_history_index(list_path) == 2
+    assert sorted(os.listdir(os.path.dirname(list_path))) == ['download_list.txt', 'download_list.txt.idx']
+    shutil.rmtree(os.path.dirname(list_path))
+
+
+def test_download_history_rebuilds_index(monkeypatch):
+    monkeypatch.setattr(trailers, 'HISTORY_INDEX_MAX_UNINDEXED', 1)
+    list_path = make_indexed_history([u'Film.Trailer.1080p.mov'], [u'A.Clip.720p.mov', u'B.Clip.720p.mov'])
+    history = trailers.load_download_history(list_path)
+
+    assert history.recent == set()
+    assert history.count == 3
+    assert u'B.Clip.720p.mov' in history
+    history.close()
+    shutil.rmtree(os.path.dirname(list_path))
+
+
+def test_download_history_without_index():
+    history = trailers.load_download_history(DOWNLOAD_LIST_FIXTURE_PATH)
+
+    assert history.index is None
+    assert u'☃.Clip.480p.mov' in history
+    assert trailers.file_already_downloaded(history, u'Film', u'Trailer 2', u'1080', u'single_trailer')
+
+
+def test_download_history_deleted_list_with_index():
+    list_path = make_indexed_history([u'Film.Trailer.1080p.mov'])
+    # Deleting the list is the way to download everything again
+    os.remove(list_path)
+    history = trailers.load_download_history(list_path)
+
+    assert history.index is None
+    assert u'Film.Trailer.1080p.mov' not in history
+    assert os.listdir(os.path.dirname(list_path)) == []
+    shutil.rmtree(os.path.dirname(list_path))
+
+
+def test_filename_index_owners_persist_across_runs_and_nodes():
+    tmp_dir = tempfile.mkdtemp()
+    filename = u'Foo.Trailer.720p.mov'
+    first_run = trailers.FilenameIndex()
+    first_run.build(tmp_dir, shared=True)
+    names = {
+        'foo1': first_run.reserve(filename, 'http://example.com/foo1/a.mov'),
+        'foo2': first_run.reserve(filename, 'http://example.com/foo2/a.mov'),
+    }
+    open(os.path.join(tmp_dir, filename), 'w').close()
+
+    # The pages resolve in the other order on the next run, and on another node
+    for _ in range(2):
+        index = trailers.FilenameIndex()
+        index.build(tmp_dir, shared=True)
+        assert index.reserve(filename, 'http://example.com/foo2/a.mov') == names['foo2']
+        assert index.reserve(filename, 'http://example.com/foo1/a.mov') == names['foo1']
+
+    assert names['foo1'] == filename
+    assert names['foo2'] != filename
+    shutil.rmtree(tmp_dir)
+
+
+def test_filename_index_in_memory_unless_shared():
+    tmp_dir = tempfile.mkdtemp()
+    index = trailers.FilenameIndex()
+    index.build(tmp_dir)
+
+    assert index.reserve(u'Foo.Trailer.720p.mov', 'http://example.com/foo/a.mov') == u'Foo.Trailer.720p.mov'
+    assert os.listdir(tmp_dir) == []
+    shutil.rmtree(tmp_dir)
+
+
+def test_filename_index_release():
+    tmp_dir = tempfile.mkdtemp()
+    filename = u'Foo.Trailer.720p.mov'
+    index = trailers.FilenameIndex()
+    index.build(tmp_dir, shared=True)
+    assert index.reserve(filename, 'http://example.com/foo1/a.mov') == filename
+    open(os.path.join(tmp_dir, filename), 'w').close()
+
+    index.release(filename, 'http://example.com/foo1/a.mov')
+
+    assert os.listdir(os.path.join(tmp_dir, trailers.FILENAME_OWNERS_DIR)) == []
+    # The file is recorded now, so it belongs to another trailer
+    other_node = trailers.FilenameIndex()
+    other_node.build(tmp_dir, shared=True)
+    assert other_node.reserve(filename, 'http://example.com/foo2/a.mov') != filename
+    shutil.rmtree(tmp_dir)
+
+
+def test_get_download_plan_entries_recorded_file_not_reserved(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    index = trailers.FilenameIndex()
+    index.build(tmp_dir, shared=True)
+    monkeypatch.setattr(trailers, 'FILENAME_INDEX', index)
+    trailer_urls = [
+        # Downloaded from an older URL in an earlier run
+        {'res': '720', 'title': 'Film', 'type': 'Trailer', 'url': 'http://example.com/new/a.mov'},
+        {'res': '720', 'title': 'Other', 'type': 'Trailer', 'url': 'http://example.com/other/a.mov'},
+    ]
+
+    entries = trailers.get_download_plan_entries(trailer_urls, [u'Film.Trailer.720p.mov'], 'all')
+
+    assert [(e['filename'], e['action']) for e in entries] == [
+        (u'Film.Trailer.720p.mov', 'skip'),
+        (u'Other.Trailer.720p.mov', 'download'),
+    ]
+    assert len(os.listdir(os.path.join(tmp_dir, trailers.FILENAME_OWNERS_DIR))) == 1
+    shutil.rmtree(tmp_dir)
+
+def test_create_marker_file():
+    tmp_dir = tempfile.mkdtemp()
+    marker_path = os.path.join(tmp_dir, 'marker')
+
+    assert trailers.create_marker_file(marker_path, u'first')
+    assert not trailers.create_marker_file(marker_path, u'second')
+    assert trailers.read_marker_file(marker_path) == u'first'
+    assert os.listdir(tmp_dir) == ['marker']
+    shutil.rmtree(tmp_dir)